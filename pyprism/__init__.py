@@ -1,3 +1,5 @@
 from pyprism.main import *
 from pyprism.engine import *
 from pyprism.parser import *
+from pyprism.session import *
+from pyprism.term import *
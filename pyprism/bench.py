@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import tempfile
+import platform
+import statistics
+import subprocess
+import datetime as dt
+import argparse
+import typing as t
+
+from pyprism.parser import tokenize, parse_term, serialize_term, read_sw_data, TermCache
+from pyprism.engine import PrismEngine
+
+# name -> (function, sizes of each profile)
+# a benchmark function takes (size, wd_path) and returns (fn, items) or
+# (fn, items, cleanup): fn is the timed call and items the number of items it
+# processes (for throughput)
+BENCHMARKS={}
+
+def benchmark(name, quick, full):
+    def decorator(f):
+        BENCHMARKS[name]=(f, {"quick":quick, "full":full})
+        return f
+    return decorator
+
+def synthetic_term(n, seed=0):
+    """A switch-like term with n arguments mixing atoms, numbers, strings, lists and operators"""
+    rng=random.Random(seed)
+    args=[]
+    for i in range(n):
+        k=i%5
+        if k==0:
+            args.append({"name":"g", "args":["a"+str(i), i, rng.random()]})
+        elif k==1:
+            args.append([i, "b"+str(i), {"unary":"-", "expr":i}])
+        elif k==2:
+            args.append("s "+str(i))
+        elif k==3:
+            args.append({"binop":"+", "left":i, "right":{"binop":"*", "left":"x", "right":rng.randint(0,9)}})
+        else:
+            args.append({"tuple":[i, "c"]})
+    return {"name":"f", "args":args}
+
+def synthetic_sw(filename, n, n_values=5, seed=0):
+    """Writes n switches in the format of save_sw/1"""
+    rng=random.Random(seed)
+    with open(filename, "w") as fp:
+        for i in range(n):
+            ps=[rng.random() for _ in range(n_values)]
+            z=sum(ps)
+            vs=",".join("v"+str(j) for j in range(n_values))
+            fp.write("switch(attr({},{}),unfixed,[{}],[{}]).\n".format(
+                i%97, i, vs, ",".join(repr(p/z) for p in ps)))
+
+def synthetic_frame(n, n_cols=10, missing=0.05, seed=0):
+    """(X, y) with n rows: continuous and discrete columns with missing cells"""
+    import numpy as np
+    import pandas as pd
+    rng=np.random.default_rng(seed)
+    cols={}
+    for j in range(n_cols):
+        if j%2==0:
+            c=rng.normal(size=n)
+        else:
+            c=rng.integers(0, 4, size=n).astype(float)
+        c[rng.random(n)<missing]=np.nan
+        cols["x"+str(j)]=c
+    X=pd.DataFrame(cols)
+    y=pd.Series(rng.normal(size=n), name="y")
+    return X, y
+
+def synthetic_db(n):
+    return "values(coin(_),[h,t]).\n"+"".join("fact({},{}).\n".format(i, i%7) for i in range(n))
+
+@benchmark("tokenize", quick=[1000, 10000], full=[1000, 10000, 100000])
+def bench_tokenize(n, wd_path):
+    s=serialize_term(synthetic_term(n))
+    return (lambda: list(tokenize(s))), n
+
+@benchmark("parse_term", quick=[1000, 10000], full=[1000, 10000, 100000])
+def bench_parse_term(n, wd_path):
+    s=serialize_term(synthetic_term(n))
+    return (lambda: parse_term(s)), n
+
+@benchmark("serialize_term", quick=[1000, 10000], full=[1000, 10000, 100000])
+def bench_serialize_term(n, wd_path):
+    obj=synthetic_term(n)
+    return (lambda: serialize_term(obj)), n
+
+@benchmark("parse_term_cached", quick=[10000], full=[10000, 100000])
+def bench_parse_term_cached(n, wd_path):
+    # query outputs repeating 50 shapes, parsed through a TermCache
+    lines=["X={},Y=[0,1,2,3,4],Z=f(a,{})".format(i%50, i%3) for i in range(n)]
+    def run():
+        cache=TermCache()
+        return [cache.parse_output(l) for l in lines]
+    return run, n
+
+@benchmark("parse_sw_line", quick=[1000], full=[1000, 10000])
+def bench_parse_sw_line(n, wd_path):
+    filename=os.path.join(wd_path, "sw_lines.sw")
+    synthetic_sw(filename, n)
+    with open(filename) as fp:
+        lines=[l.strip()[:-1] for l in fp]
+    return (lambda: [parse_term(l) for l in lines]), n
+
+@benchmark("read_sw_data", quick=[1000, 10000], full=[1000, 10000, 100000])
+def bench_read_sw_data(n, wd_path):
+    filename=os.path.join(wd_path, "read_sw_data_{}.sw".format(n))
+    synthetic_sw(filename, n)
+    return (lambda: read_sw_data(filename, use_array=True)), n
+
+@benchmark("sw2df", quick=[1000, 10000], full=[1000, 10000, 100000])
+def bench_sw2df(n, wd_path):
+    from pyprism.df import sw2df
+    filename=os.path.join(wd_path, "sw2df_{}.sw".format(n))
+    synthetic_sw(filename, n)
+    return (lambda: sw2df(filename)), n
+
+@benchmark("to_dat", quick=[10000], full=[10000, 100000, 1000000])
+def bench_to_dat(n, wd_path):
+    from pyprism.dataset import to_dat
+    X, y=synthetic_frame(n, missing=0.0)
+    X=X.round()
+    y=y.round()
+    X.iloc[::17, 1]=float("nan")
+    filename=os.path.join(wd_path, "to_dat.dat")
+    return (lambda: to_dat(X, y, filename)), n
+
+@benchmark("preprocess", quick=[10000], full=[10000, 100000, 1000000])
+def bench_preprocess(n, wd_path):
+    from pyprism.dataset import preprocess
+    X, y=synthetic_frame(n)
+    filename=os.path.join(wd_path, "preprocess.dat")
+    return (lambda: preprocess(X, y, out_filename=filename)), n
+
+def engine_for(n, wd_path, **kwargs):
+    engine=PrismEngine(wd_path=os.path.join(wd_path, "prism_code")+"/", **kwargs)
+    engine.set_db(synthetic_db(n))
+    return engine
+
+def checked_query(engine, q):
+    msgs, status=engine.query(q, err_verbose=False)
+    if status!="yes":
+        raise RuntimeError("query {} failed: {}".format(q, status))
+    return msgs
+
+@benchmark("engine_query_cold", quick=[100], full=[100, 1000, 2000])
+def bench_engine_query_cold(n, wd_path):
+    # every call starts PRISM and compiles the db with n facts
+    engine=engine_for(n, wd_path)
+    return (lambda: checked_query(engine, "fact(1,X)")), 1
+
+@benchmark("engine_query_cached", quick=[100], full=[100, 1000, 2000])
+def bench_engine_query_cached(n, wd_path):
+    # every call starts PRISM and loads the db compiled beforehand
+    engine=engine_for(n, wd_path, cache=True)
+    checked_query(engine, "fact(1,X)")
+    return (lambda: checked_query(engine, "fact(1,X)")), 1
+
+@benchmark("engine_query_session", quick=[100], full=[100, 1000, 2000])
+def bench_engine_query_session(n, wd_path):
+    # queries to a running PRISM process
+    engine=engine_for(n, wd_path)
+    engine.start_session()
+    checked_query(engine, "fact(1,X)")
+    return (lambda: checked_query(engine, "fact(1,X)")), 1, engine.stop_session
+
+def measure(fn, repeat):
+    times=[]
+    for _ in range(repeat):
+        t0=time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-t0)
+    return times
+
+def run_benchmark(name, size, repeat=3, wd_path=None):
+    """Runs one benchmark and returns its result (seconds per call and items per second)"""
+    f, _=BENCHMARKS[name]
+    result={"name":name, "size":size, "repeat":repeat}
+    wd=tempfile.mkdtemp(prefix="pyprism-bench-", dir=wd_path)
+    try:
+        fn, items, *cleanup=f(size, wd)
+        try:
+            times=measure(fn, repeat)
+        finally:
+            for c in cleanup:
+                c()
+        result.update({
+            "items":items,
+            "times":times,
+            "min":min(times),
+            "median":statistics.median(times),
+            "mean":statistics.mean(times),
+            "items_per_sec":items/min(times) if min(times)>0 else None,
+            })
+    except Exception as e:
+        # e.g. a missing PRISM binary or optional dependency
+        result["error"]="{}: {}".format(type(e).__name__, e)
+    finally:
+        shutil.rmtree(wd, ignore_errors=True)
+    return result
+
+def environment():
+    env={"python":platform.python_version(),
+        "platform":platform.platform(),
+        "created":dt.datetime.now().isoformat(timespec="seconds")}
+    try:
+        from importlib.metadata import version
+        env["pyprism"]=version("pyprism")
+    except Exception:
+        env["pyprism"]=None
+    try:
+        r=subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        env["revision"]=r.stdout.decode("utf8").strip() if r.returncode==0 else None
+    except (OSError, subprocess.TimeoutExpired):
+        env["revision"]=None
+    for mod in ["numpy", "pandas"]:
+        try:
+            env[mod]=__import__(mod).__version__
+        except ImportError:
+            env[mod]=None
+    return env
+
+def run_benchmarks(names=None, profile="quick", sizes=None, repeat=3, wd_path=None, progress=None):
+    """Runs the benchmarks (all by default) with the sizes of profile
+    ("quick" or "full") or the given sizes and returns the report as a dict"""
+    names=list(BENCHMARKS) if names is None else names
+    results=[]
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError("unknown benchmark: "+name)
+        for size in sizes if sizes is not None else BENCHMARKS[name][1][profile]:
+            r=run_benchmark(name, size, repeat, wd_path)
+            if progress is not None:
+                progress(r)
+            results.append(r)
+    return {"environment":environment(), "profile":profile, "results":results}
+
+def compare(report, base):
+    """Ratios of the median times of report to those of base for each (name, size)"""
+    base_={(r["name"], r["size"]):r for r in base["results"] if "error" not in r}
+    out=[]
+    for r in report["results"]:
+        b=base_.get((r["name"], r["size"]))
+        if b is None or "error" in r:
+            continue
+        out.append((r["name"], r["size"], b["median"], r["median"], r["median"]/b["median"]))
+    return out
+
+def format_result(r):
+    if "error" in r:
+        return "{:<22}{:>10}  error: {}".format(r["name"], r["size"], r["error"])
+    ips=r["items_per_sec"]
+    return "{:<22}{:>10}  median {:10.6f}s  min {:10.6f}s  {:>14} items/s".format(
+            r["name"], r["size"], r["median"], r["min"], "{:.1f}".format(ips) if ips is not None else "-")
+
+def main(argv: t.Optional[t.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+            prog='pyprism-bench',
+            description='pyprism benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--profile', choices=['quick', 'full'], default='quick', help='sizes to run')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None, help='sizes instead of those of the profile')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per size')
+    parser.add_argument('-o', '--output', default=None, help='JSON file to save the results')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks')
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, (_, sizes) in BENCHMARKS.items():
+            print("{:<22} quick={} full={}".format(name, sizes["quick"], sizes["full"]))
+        return
+    report=run_benchmarks(args.benchmarks or None, args.profile, args.sizes, args.repeat,
+            progress=lambda r: print(format_result(r), flush=True))
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            base=json.load(fp)
+        print("==compare==")
+        for name, size, b, m, ratio in compare(report, base):
+            print("{:<22}{:>10}  {:10.6f}s -> {:10.6f}s  x{:.2f}".format(name, size, b, m, ratio))
+    if any("error" in r for r in report["results"]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
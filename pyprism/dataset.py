@@ -1,3 +1,5 @@
+import io
+import gzip
 import sklearn
 import matplotlib.pyplot as plt
 import numpy as np
@@ -142,36 +144,90 @@ def to_dat(
     out_filename: str = "output.dat",
     pred: str = "data",
     with_y=True,
+    chunk_size: int = 100000,
+    compression: str = None,
 ):
-    data = []
-    # Ensure both X_discretized and y_discretized have the same index for alignment
-    # If y_discretized might have missing indices compared to X_discretized,
-    # we need to align them. Let's use the index of X_discretized as the base.
-    aligned_y = y_discretized.reindex(X_discretized.index)
-
-    for index, row in X_discretized.iterrows():
-        # Convert row to list and handle NaN
-        row_list = [str(int(x)) if pd.notna(x) else "_" for x in row.tolist()]
-
-        # Get the corresponding y value, handling NaN
-        y_value = (
-            aligned_y.loc[index]
-            if index in aligned_y.index and pd.notna(aligned_y.loc[index])
-            else "_"
-        )
-        if y_value != "_":
-            y_value = str(int(y_value))
-
-        # Combine the row list and the y value
-        data.append((row_list, y_value))
-
-    # Write to dat file
-    with open(out_filename, "w") as fp:
-        for row, y_value in data:
-            if with_y:
-                fp.write(pred + "(" + y_value + ",[" + ",".join(row) + "]).\n")
-            else:
-                fp.write(pred + "([" + ",".join(row) + "]).\n")
+    """
+  Writes the rows of X_discretized (and y_discretized) as PRISM facts
+  pred(y,[x1,...,xn]). (or pred([x1,...,xn]). without y); values are
+  written as integers and missing values as _.
+
+  Args:
+    out_filename: A path (a named pipe works too) or an open file object,
+      e.g. the stdin of a PRISM process.
+    chunk_size: The number of rows formatted and written at a time.
+    compression: "gzip" to write gzip-compressed output (the default for
+      paths ending with .gz).
+  """
+    if hasattr(out_filename, "write"):
+        fp = out_filename
+        if isinstance(fp, io.TextIOBase):
+            write = fp.write
+        else:
+            write = lambda text: fp.write(text.encode("utf8"))
+        for chunk in dat_chunks(X_discretized, y_discretized, pred, with_y, chunk_size):
+            write(chunk)
+        return
+    if compression is None and str(out_filename).endswith(".gz"):
+        compression = "gzip"
+    if compression == "gzip":
+        fp = gzip.open(out_filename, "wt", compresslevel=6)
+    elif compression is None:
+        fp = open(out_filename, "w")
+    else:
+        raise ValueError(f"Unsupported compression: {compression}")
+    with fp:
+        for chunk in dat_chunks(X_discretized, y_discretized, pred, with_y, chunk_size):
+            fp.write(chunk)
+
+
+def dat_chunks(X_discretized, y_discretized, pred="data", with_y=True, chunk_size=100000):
+    """Yields the text of to_dat for chunk_size rows at a time"""
+    # Align y with the rows of X_discretized
+    if with_y:
+        aligned_y = y_discretized.reindex(X_discretized.index).to_numpy()
+    for start in range(0, len(X_discretized), chunk_size):
+        # The rows of X_discretized have one common dtype, as in iterrows()
+        block = X_discretized.iloc[start : start + chunk_size].to_numpy()
+        cols = [_dat_cells(block[:, j]) for j in range(block.shape[1])]
+        rows = [",".join(r) for r in zip(*cols)] if len(cols) > 0 else [""] * len(block)
+        if with_y:
+            ys = _dat_cells(aligned_y[start : start + chunk_size])
+            yield "".join([pred + "(" + y + ",[" + r + "]).\n" for y, r in zip(ys, rows)])
+        else:
+            yield "".join([pred + "([" + r + "]).\n" for r in rows])
+
+
+def _dat_cells(values):
+    # str(int(x)) of each value and "_" for missing values
+    missing = pd.isna(values)
+    if values.dtype.kind in "iub" or (values.dtype.kind == "f" and not missing.all()):
+        if values.dtype.kind == "f":
+            present = values[~missing]
+            if not (np.isfinite(present).all() and (np.abs(present) < 2.0**63).all()):
+                return _dat_cells_objects(values, missing)
+            ints = np.trunc(np.where(missing, 0, values)).astype(np.int64)
+        elif values.dtype.kind == "u" and len(values) > 0 and values.max() > np.iinfo(np.int64).max:
+            # would wrap around in int64
+            return _dat_cells_objects(values, missing)
+        else:
+            ints = values.astype(np.int64)
+        if len(ints) == 0:
+            return []
+        lo, hi = int(ints.min()), int(ints.max())
+        if hi - lo < 100000:
+            # small ranges (like bins) are formatted once per value
+            table = np.array([str(i) for i in range(lo, hi + 1)], dtype=object)
+            cells = table[ints - lo]
+        else:
+            cells = np.array(list(map(str, ints.tolist())), dtype=object)
+        cells[missing] = "_"
+        return cells.tolist()
+    return _dat_cells_objects(values, missing)
+
+
+def _dat_cells_objects(values, missing):
+    return ["_" if m else str(int(x)) for x, m in zip(values.tolist(), missing.tolist())]
 
 
 def apply_discretizer(X, discretizers, thresh_uniq=10):
@@ -1,4 +1,5 @@
-from pyprism.parser import read_sw_data
+from pyprism.parser import read_sw_data, sw_data
+from pyprism.records import record_columns2df
 import sklearn
 import matplotlib.pyplot as plt
 import numpy as np
@@ -6,14 +7,24 @@ from sklearn.preprocessing import KBinsDiscretizer
 import pandas as pd
 
 
-def sw2df(filename):
-    data, m = read_sw_data(filename, use_array=True)
+def sw2df(filename, cache=None):
+    data, m = read_sw_data(filename, use_array=True, cache=cache)
+    return sw_data2df(data, m)
+
+
+def sw_data2df(data, m):
     h1 = ["Name", "Arity", "Term", "Status", "Vals", "Param"]
     h2 = ["Arg" + str(i + 1) for i in range(m)]
     data_ = [line + args + [""] * (m - len(args)) for line, args in data]
     return pd.DataFrame(data_, columns=h1 + h2)
 
 
+def sw_list2df(sw_list):
+    """Switch records (as returned by read_sw or PrismEngine.learn) to a DataFrame like sw2df"""
+    data, m = sw_data(sw_list, use_array=True)
+    return sw_data2df(data, m)
+
+
 # Function to extract conditional probability distribution from a DataFrame
 def get_conditional_dist(df_, arg_cond="Arg2"):
     data = []  # List to hold the probability values
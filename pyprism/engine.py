@@ -1,13 +1,230 @@
 import os
 import sys
 import glob
+import time
+import copy
+import queue
+import asyncio
+import hashlib
 import subprocess
-import datetime as dt
-import argparse
+import re
+import signal
+import platform
+import threading
+import functools
+import contextlib
+import concurrent.futures
 import typing as t
+from pyprism.session import PrismSession, EXEC_DB, READY_MARK, END_MARK, parse_frames
+from pyprism.parser import parse_output, parse_records, parse_record_columns, parse_record_value, parse_term, serialize_term, sw_record
+from pyprism.main import write_program, remove_program
+from pyprism.metrics import Metrics, STAT_DB, stat_main, split_stats, parse_statistics, logger
+
+# the first M solutions of Goal, each written by Emit as soon as it is found;
+# fails if Goal has fewer than M solutions. The count is kept in a global
+# variable so that nothing is asserted per solution
+FIND_N_DB="""
+$find_n(Goal,Emit,M):-
+    global_set($pyprism_find_n,0,0),
+    ( call(Goal),call(Emit),
+      global_get($pyprism_find_n,0,N),N1 is N+1,global_set($pyprism_find_n,0,N1),
+      N1>=M,! ; true ),
+    global_get($pyprism_find_n,0,Found),
+    Found>=M.
+"""
+
+# bulk updates of the db: facts are sent as one list per goal, and
+# $pyprism_retract/2 counts the clauses it removes
+UPDATE_DB="""
+$pyprism_assertz([]).
+$pyprism_assertz([F|Fs]):-assertz(F),$pyprism_assertz(Fs).
+$pyprism_retract(P,N):-
+    global_set($pyprism_retracted,0,0),
+    ( retract(P),
+      global_get($pyprism_retracted,0,N0),N1 is N0+1,global_set($pyprism_retracted,0,N1),
+      fail
+    ; true ),
+    global_get($pyprism_retracted,0,N).
+"""
+
+# learning from goals read from stdin; statistics and learned switches are
+# written as records with the parameters in full precision
+LEARN_DB="""
+$pyprism_read_goals(Gs):-read(G),
+    ( G==end_of_file -> Gs=[] ; Gs=[G|Gs1],$pyprism_read_goals(Gs1) ).
+$pyprism_num(X):-float(X),!,format("~16e",[X]).
+$pyprism_num(X):-writeq(X).
+$pyprism_nums([]).
+$pyprism_nums([X]):-!,$pyprism_num(X).
+$pyprism_nums([X|Xs]):-$pyprism_num(X),write(','),$pyprism_nums(Xs).
+$pyprism_learn(Stats):-
+    $pyprism_read_goals(Gs),
+    learn(Gs),
+    ( member(K,Stats),catch(learn_statistics(K,V),_,fail),
+      put_code(2),write(stat),put_code(31),writeq(K),put_code(31),$pyprism_num(V),put_code(3),nl,
+      fail
+    ; true ),
+    get_reg_sw_list(Sws),
+    ( member(S,Sws),get_sw(S,[St,Vs,Ps]),
+      put_code(2),write(sw),put_code(31),writeq(S),put_code(31),writeq(St),put_code(31),writeq(Vs),
+      put_code(31),write('['),$pyprism_nums(Ps),write(']'),put_code(3),nl,
+      fail
+    ; true ).
+"""
+LEARN_STATISTICS=["log_likelihood","log_prior","log_post","lambda","bic","cs","free_energy",
+    "num_switches","num_switch_values","num_parameters","num_iterations","num_iterations_vb",
+    "learn_time","learn_search_time","em_time"]
+
+### memory areas of PRISM (same defaults as bin/upprism)
+DEFAULT_AREAS={
+    "parea":8000000,   # size of program area
+    "stack":10000000,  # size of control stack and heap
+    "trail":2000000,   # size of trail stack
+    "table":10000000,  # size of table area
+}
+AREA_OPTIONS={"parea":"-p", "stack":"-s", "trail":"-b", "table":"-t"}
+# prefix of compiled-program cache entries being written
+CACHE_TMP_PREFIX="tmp-"
+# PRISM's own reports of an exhausted memory area: an uncaught
+# resource_error(out_of_memory) exception (also as the status of a framed
+# goal, see session.EXEC_DB) and the overflow messages of the runtime on stderr
+OVERFLOW_EXCEPTION_PATTERN=re.compile(r"^(\x01\$pyprism_end )?Aborted by exception -- error\(resource_error\(out_of_memory(?:\),\s*|,\s*)([A-Za-z_]+)\)")
+OVERFLOW_MESSAGE_PATTERN=re.compile(r'^(Stack|TRAIL stack|Program area) overflow in "')
+
+def prism_binary(bin_path, mp=False):
+    kind="mp" if mp else "up"
+    system=platform.system()
+    if system=="Darwin":
+        return bin_path+"/prism_"+kind+"_darwin.bin"
+    elif system.startswith("CYGWIN"):
+        return bin_path+"/prism_"+kind+"_cygwin.exe"
+    return bin_path+"/prism_"+kind+"_linux.bin"
+
+def overflow_area(out, err, returncode):
+    """Returns the memory area that a run of PRISM failed on, or None
+
+    Only PRISM's own messages at the beginning of a line count: a framed goal
+    aborted by resource_error(out_of_memory), or, when PRISM exited with an
+    error, an uncaught resource_error(out_of_memory) or an overflow message
+    on stderr. Output written by the program itself does not.
+    """
+    for line in out:
+        m=OVERFLOW_EXCEPTION_PATTERN.match(line)
+        if m is not None and (m.group(1) is not None or returncode!=0):
+            return area_of(m.group(2))
+    if returncode!=0:
+        for line in err:
+            m=OVERFLOW_MESSAGE_PATTERN.match(line)
+            if m is not None:
+                return area_of(m.group(1))
+    return None
+
+def area_of(name):
+    # memory area of a name used in PRISM's messages
+    name=name.lower()
+    if "stack" in name or "heap" in name:
+        return "trail" if "trail" in name else "stack"
+    for area in ["trail","table"]:
+        if area in name:
+            return area
+    if "program" in name or "code" in name or "parea" in name:
+        return "parea"
+    return None
+
+def goal_lines(data, pred=None):
+    """Yields data as lines of Prolog goals: data is an iterable of goals or a
+    DataFrame whose rows become pred(Col1,...,ColN) (NaN becomes _)"""
+    if hasattr(data, "itertuples"):
+        if pred is None:
+            raise ValueError("pred is required to convert a DataFrame to goals")
+        for row in data.itertuples(index=False, name=None):
+            yield pred+"("+",".join([prolog_value(v) for v in row])+").\n"
+    else:
+        for g in data:
+            g=g.strip()
+            yield (g if g[-1]=="." else g+".")+"\n"
+
+def prolog_value(v):
+    """Prolog text of a value: integers (also numpy integer types) as integers,
+    floats in float syntax, None/NaN as _, strings as atoms"""
+    kind=getattr(getattr(v, "dtype", None), "kind", None)
+    if v is None or type(v).__name__=="NAType":
+        return "_"
+    if isinstance(v, bool) or kind=="b":
+        return "true" if v else "false"
+    if isinstance(v, int) or kind in ("i", "u"):
+        return str(int(v))
+    if isinstance(v, float) or kind=="f":
+        return prolog_float(float(v))
+    return serialize_term(v) if re.match(r'^[a-z][A-Za-z_0-9]*$', str(v)) else quote_atom(str(v))
+
+def prolog_float(x):
+    # B-Prolog needs a fractional part: 1e-05 is written as 1.0e-05
+    if x!=x:
+        return "_"
+    if x in (float("inf"), float("-inf")):
+        raise ValueError("{} cannot be written as a Prolog number".format(x))
+    r=repr(x)
+    mantissa, e, exponent=r.partition("e")
+    if "." not in mantissa:
+        mantissa+=".0"
+    return mantissa+e+exponent
+
+def communicate(proc, input, timeout):
+    """Writes the lines of input to proc while collecting its output;
+    returns (stdout, stderr, timed_out)"""
+    out, err=[], []
+    def read(fp, buf):
+        buf.append(fp.read())
+    def feed():
+        try:
+            for line in input:
+                proc.stdin.write(line.encode("utf8"))
+            proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+    threads=[threading.Thread(target=read, args=(proc.stdout, out), daemon=True),
+        threading.Thread(target=read, args=(proc.stderr, err), daemon=True),
+        threading.Thread(target=feed, daemon=True)]
+    for th in threads:
+        th.start()
+    timed_out=False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out=True
+        kill_process_group(proc)
+        proc.wait()
+    except BaseException:
+        kill_process_group(proc)
+        proc.wait()
+        raise
+    for th in threads:
+        th.join()
+    return b"".join(out), b"".join(err), timed_out
+
+def kill_process_group(proc):
+    # PRISM runs in its own session, so this also stops anything it spawned
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def metered(call):
+    """Records the Metrics of an engine method (see PrismEngine.metering)"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            with self.metering(call):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def quote_atom(s):
+    return "'"+s.replace("\\","\\\\").replace("'","\\'")+"'"
 
 class PrismEngine:
-    def __init__(self,bin_path=None, wd_path='./.prism_code/'):
+    def __init__(self,bin_path=None, wd_path='./.prism_code/', cache=False, cache_max_bytes=1<<30, cache_max_age=7*24*3600, max_concurrency=None, keep_files=False, areas=None, max_areas=None, timeout=None, cpu_limit=None, memory_limit=None, mp_procs=None, mp_launcher=["mpirun","-np","{procs}"]):
         if bin_path is None:
             path=os.path.dirname(os.path.abspath(__file__))
             bin_path=path+"/bin"
@@ -17,11 +234,95 @@ class PrismEngine:
         self.result_stdout=None
         self.result_stderr=None
         self.db=""
-    
+        # goals adding/retracting clauses after the db (see add_facts)
+        self.db_updates=[]
+        self.session=None
+        self.session_updates=0
+        ### deadline in seconds and rlimits (CPU seconds, address space bytes) of PRISM
+        self.timeout=timeout
+        self.cpu_limit=cpu_limit
+        self.memory_limit=memory_limit
+        self.timed_out=False
+        ### memory areas; on an overflow the run is retried with twice the
+        ### overflowed area until it reaches max_areas (default: 16 times larger)
+        self.areas={**DEFAULT_AREAS, **(areas or {})}
+        self.max_areas=max_areas if max_areas is not None else {k:v*16 for k,v in self.areas.items()}
+        self.last_areas=None
+        ### parallel PRISM: run prism_mp_*.bin on mp_procs processes started by
+        ### mp_launcher ("{procs}" is replaced by the number of processes)
+        self.mp_procs=mp_procs
+        self.mp_launcher=mp_launcher
+        ### keep generated .psm/.psm.out files for debugging
+        self.keep_files=keep_files
+        ### limit of concurrent PRISM processes started by aquery/arun
+        self.max_concurrency=max_concurrency
+        self._semaphore=None
+        ### compiled-program cache under wd_path/cache
+        self.cache=cache
+        self.cache_path=wd_path+"/cache"
+        self.cache_max_bytes=cache_max_bytes
+        self.cache_max_age=cache_max_age
+        ### per-call timing: last_metrics holds the Metrics of the last call and
+        ### metrics_hook (if set) is called with each of them
+        self.metrics_hook=None
+        self.last_metrics=None
+        self._metrics=None
+        ### LRU cache of parsed outputs and switches (a TermCache); None parses every line
+        self.term_cache=None
+
     def set_db(self, code):
         self.db=code
+        self.db_updates=[]
+
+    ### incremental updates of the db
+    def add_facts(self, pred, rows, chunk_size=10000):
+        """Adds the facts pred(*row) for each row (a sequence of values or a DataFrame)
+
+        The predicate has to be declared dynamic in the db (:- dynamic pred/N).
+        The facts are sent in chunks to the running session (see
+        start_session); a RuntimeError is raised when PRISM rejects a chunk.
+        Batch runs of the engine (e.g. learn) add them before their program.
+        """
+        if hasattr(rows, "itertuples"):
+            rows=rows.itertuples(index=False)
+        head=prolog_value(pred)
+        chunk=[]
+        for row in rows:
+            if not isinstance(row, (list, tuple)):
+                row=[row]
+            chunk.append(head+"("+",".join(prolog_value(v) for v in row)+")")
+            if len(chunk)>=chunk_size:
+                self.update_db("$pyprism_assertz(["+",".join(chunk)+"])")
+                chunk=[]
+        if len(chunk)>0:
+            self.update_db("$pyprism_assertz(["+",".join(chunk)+"])")
 
-    def query(self, q, find_n=None, findall=False, out=None, err_verbose=True, verbose=False,args=[]):
+    def retract(self, pattern):
+        """Removes the clauses (facts or Head:-Body) unifying with pattern
+
+        Returns the number of removed clauses; needs a session like add_facts
+        """
+        if pattern.strip()[-1]==".":
+            pattern=pattern.strip()[:-1]
+        rows=self.update_db("$pyprism_retract(({}),_)".format(pattern), "$pyprism_retract(({}),N_),$pyprism_rec([N_])".format(pattern))
+        return rows[0][0]
+
+    def update_db(self, goal, session_goal=None):
+        # db_updates is replaced, not appended to: engines copied by map() share it
+        if self.session is None:
+            # without a session every program would have to repeat the updates
+            raise RuntimeError("updates of the db need a session: call start_session() first")
+        self.sync_session()
+        msgs, status=self.session.query(session_goal or goal, timeout=self.timeout)
+        if status!="yes":
+            # the session may have been partly updated: it restarts without this goal
+            self.session.close()
+            raise RuntimeError("update failed: "+status+"\n"+"\n".join((self.session.result_stdout or [])+(self.session.result_stderr or [])))
+        self.db_updates=self.db_updates+[goal]
+        self.session_updates=len(self.db_updates)
+        return parse_records("\n".join(msgs))
+
+    def build_query(self, q, find_n=None, findall=False, out=None):
         ### generate query
         if q.strip()[-1]==".":
             q=q.strip()[:-1]
@@ -32,40 +333,18 @@ class PrismEngine:
         if out is not None:
             if isinstance(out, str):
                 out=[out]
-            if len(out)>0 and not findall and find_n is None:
+            if len(out)>0 and (find_n is not None or not findall):
                 s=",".join(['format("{}=~w,",[{}])'.format(el,el) for el in out[:-1]])
                 if len(out)==1:
                     s='format("{}=~w\n",[{}])'.format(out[-1],out[-1])
                 else:
                     s+=',format("{}=~w\n",[{}])'.format(out[-1],out[-1])
-                q=q+","+s
-            elif len(out)>0 and find_n is not None:
-                find_n_db="""
-$find_n(G,M):-assert($solution_count(0)),!,
-    call(G),
-    $solution_count(N),
-    assert($find_n_solution(G)),
-    N1 is N+1,
-    retract($solution_count(N)),
-    assert($solution_count(N1)),
-    N1>=M.
-$find_n(Vars, Goal, M, Out):-
-    copy_term(Goal,Goal_),
-    $find_n(Goal_, M),
-    $find_n_solution(G1),
-    findall(Vars,($find_n_solution(G),G=Goal),Out).
-
-    """
-                s="'"+"','".join(out)+"'"
-                q=""" $find_n([{}],({}),{},_Temp_),
-                  maplist(_TempX_ ,
-                    ( [_TempXSym1_|_TempXSymR_]=[{}],
-                      [_TempX1_|_TempXR_]=_TempX_,
-                      format("~w=~w",[_TempXSym1_,_TempX1_]),
-                    maplist(_TempXSym_,_TempXEl_,
-                      (format(",~w=~w",[_TempXSym_,_TempXEl_]))
-                      ,_TempXSymR_,_TempXR_),
-                    format("\n") ) ,_Temp_)""".format(",".join(out),q,find_n,s)
+                if find_n is None:
+                    q=q+","+s
+                else:
+                    # find_n takes precedence over findall
+                    find_n_db=FIND_N_DB
+                    q="$find_n(({}),({}),{})".format(q,s,find_n)
 
             elif len(out)>0 and findall:
                 s="'"+"','".join(out)+"'"
@@ -78,15 +357,298 @@ $find_n(Vars, Goal, M, Out):-
                       (format(",~w=~w",[_TempXSym_,_TempXEl_]))
                       ,_TempXSymR_,_TempXR_),
                     format("\n") ) ,_Temp_)""".format(",".join(out),q,s)
+        return q, find_n_db
+
+    @metered("query")
+    def query(self, q, find_n=None, findall=False, out=None, err_verbose=True, verbose=False,args=[], areas=None, timeout=None):
+        with self.phase("build"):
+            q, find_n_db=self.build_query(q, find_n=find_n, findall=findall, out=out)
         if verbose:
             print("new query:",q)
-        code=self.db+"\n"+find_n_db+"\nprism_main :-"+q+".\n"
         ### run
-        out=self.run(code,args)
+        if self.session is not None and len(args)==0:
+            return self.query_session(q, verbose=verbose, err_verbose=err_verbose, timeout=timeout)
+        code=self.program(find_n_db, q, args)
+        out=self.run(code,args,areas,timeout)
+        if verbose:
+            print("\n".join(self.result_stdout))
+        if err_verbose:
+            print("\n".join(self.result_stderr), file=sys.stderr)
+        if self.timed_out:
+            # the partial output is kept in result_stdout
+            return None, "timeout"
+        with self.phase("parse"):
+            return self.parse_result(out)
+
+    @metered("query_many")
+    def query_many(self, goals, find_n=None, findall=False, out=None, err_verbose=True, verbose=False,args=[], areas=None, timeout=None):
+        """Runs every goal in one PRISM invocation and returns a list of (msgs, status), one per goal"""
+        qs=[]
+        find_n_db=""
+        with self.phase("build"):
+            for g in goals:
+                q, db=self.build_query(g, find_n=find_n, findall=findall, out=out)
+                qs.append(q)
+                find_n_db=find_n_db or db
+        if verbose:
+            print("new queries:","\n".join(qs))
+        if self.session is not None and len(args)==0:
+            return [self.query_session(q, verbose=verbose, err_verbose=err_verbose, timeout=timeout) for q in qs]
+        # one predicate per goal so that goals do not share variables and
+        # a goal with a syntax error is reported as an exception
+        clauses="".join(["$pyprism_goal_{} :-{}.\n".format(i,q) for i,q in enumerate(qs)])
+        main="$pyprism_ready"
+        main+="".join([",\n    $pyprism_exec($pyprism_goal_{})".format(i) for i in range(len(qs))])
+        code=self.program(find_n_db+EXEC_DB+clauses, main, args)
+        out=self.run(code,args,areas,timeout)
+        if verbose:
+            print("\n".join(self.result_stdout))
+        if err_verbose:
+            print("\n".join(self.result_stderr), file=sys.stderr)
+        # goals that did not finish before the deadline or a crash
+        with self.phase("parse"):
+            return parse_frames(out, len(qs), "timeout" if self.timed_out else "error")
+
+    def iter_query(self, q, out, find_n=None, args=[], areas=None):
+        """Yields the solutions of q as parse_output() lists while PRISM prints them
+
+        At most find_n solutions are enumerated. Closing the iterator early
+        terminates the PRISM process.
+        """
+        if isinstance(out, str):
+            out=[out]
+        if q.strip()[-1] in [".",","]:
+            q=q.strip()[:-1]
+        fmt=",".join([el+"=~w" for el in out])
+        line='format("{}\\n",[{}]),flush_output'.format(fmt,",".join(out))
+        goal=self.solution_loop(q, line, find_n)
+        main="$pyprism_ready,flush_output,$pyprism_exec($pyprism_goal_0)"
+        code=self.program(EXEC_DB+"$pyprism_goal_0 :-"+goal+".\n", main, args)
+        filename=self.program_file(code)
+        cmds=self.command(areas)+[filename]+args
+        proc=subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        err=[]
+        err_thread=threading.Thread(target=lambda: err.extend(proc.stderr), daemon=True)
+        err_thread.start()
+        lines=[]
+        status=None
+        parse=self.term_cache.parse_output if self.term_cache is not None else parse_output
+        try:
+            started=False
+            for l in proc.stdout:
+                l=l.decode("utf8").rstrip("\n")
+                lines.append(l)
+                if not started:
+                    started=(l==READY_MARK)
+                elif l.startswith(END_MARK):
+                    status=l[len(END_MARK)+1:]
+                    break
+                elif l!="" and l[:10]!="** Warning":
+                    yield parse(l)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            err_thread.join()
+            proc.stdout.close()
+            proc.stderr.close()
+            self.remove_program_file(filename)
+            self.result_stdout=lines
+            self.result_stderr=split_stats([el.decode("utf8").rstrip("\n") for el in err])
+        if status is None:
+            raise RuntimeError("PRISM exited before the query finished:\n"+"\n".join(self.result_stderr))
+        if status not in ["yes","no"]:
+            raise RuntimeError(status)
+
+    def solution_loop(self, q, emit, find_n=None):
+        # failure-driven loop running emit for each solution as soon as it is found
+        if find_n is None:
+            return "( ({}),{},fail ; true )".format(q,emit)
+        return """global_set($pyprism_count,0,0),
+    ( ({}),{},
+      global_get($pyprism_count,0,N_),N1_ is N_+1,global_set($pyprism_count,0,N1_),
+      N1_>={},! ; true )""".format(q,emit,find_n)
+
+    @metered("query_records")
+    def query_records(self, q, out, find_n=None, as_frame=False, err_verbose=True, verbose=False, args=[], areas=None, timeout=None):
+        """Runs q and returns (rows, status) with one row of out values per solution
+
+        Each solution is written by PRISM as one writeq record framed by control
+        characters and all records are decoded in one pass with parse_records().
+        With as_frame=True, rows is a pandas DataFrame with the columns out.
+        """
+        if isinstance(out, str):
+            out=[out]
+        text, status=self.record_output(q, out, find_n, err_verbose, verbose, args, areas, timeout)
+        with self.phase("parse"):
+            rows=parse_records(text)
+            if as_frame:
+                import pandas as pd
+                rows=pd.DataFrame(rows, columns=out)
+        return rows, status
+
+    @metered("query_df")
+    def query_df(self, q, out, find_n=None, findall=True, err_verbose=True, verbose=False, args=[], areas=None, timeout=None):
+        """Runs q and returns its solutions as a DataFrame with one column per out variable
+
+        The solutions are read as records (see query_records), split into
+        columns at once and each column is typed in bulk (see records.record_columns2df):
+        int64/Int64, float64, or strings for atoms and compound terms; unbound
+        variables are missing values. With findall=False only the first
+        solution is returned, as in query().
+        """
+        if isinstance(out, str):
+            out=[out]
+        if not findall and find_n is None:
+            find_n=1
+        text, status=self.record_output(q, out, find_n, err_verbose, verbose, args, areas, timeout)
+        if status=="timeout":
+            raise TimeoutError("PRISM query did not finish in time")
+        if status not in ["yes","no"]:
+            raise RuntimeError("PRISM query failed: "+str(status))
+        with self.phase("parse"):
+            from pyprism.records import record_columns2df
+            return record_columns2df(parse_record_columns(text, len(out)), out)
+
+    def record_output(self, q, out, find_n=None, err_verbose=True, verbose=False, args=[], areas=None, timeout=None):
+        # runs q writing a record of the out values per solution; returns (output text, status)
+        if q.strip()[-1] in [".",","]:
+            q=q.strip()[:-1]
+        goal=self.solution_loop(q, "$pyprism_rec([{}])".format(",".join(out)), find_n)
+        if verbose:
+            print("new query:",goal)
+        if self.session is not None and len(args)==0:
+            msgs, status=self.query_session(goal, verbose=verbose, err_verbose=err_verbose, timeout=timeout)
+        else:
+            main="$pyprism_ready,$pyprism_exec($pyprism_goal_0)"
+            code=self.program(EXEC_DB+"$pyprism_goal_0 :-"+goal+".\n", main, args)
+            res=self.run(code,args,areas,timeout)
+            if verbose:
+                print("\n".join(self.result_stdout))
+            if err_verbose:
+                print("\n".join(self.result_stderr), file=sys.stderr)
+            msgs, status=parse_frames(res, 1, "timeout" if self.timed_out else "error")[0]
+        # after a timeout the records printed so far are returned
+        return "\n".join(msgs if msgs is not None else self.result_stdout), status
+
+    @metered("learn")
+    def learn(self, data, pred=None, flags={}, as_frame=False, err_verbose=True, verbose=False, args=[], areas=None, timeout=None):
+        """Learns the switch parameters of the db from data and returns (switches, stats)
+
+        data is an iterable of goals or a DataFrame whose rows become
+        pred(Col1,...,ColN) goals; the goals are streamed to PRISM through its
+        standard input. flags are set with set_prism_flag/2 before learning.
+        switches is a list of switch records as returned by read_sw() (a
+        DataFrame like df.sw2df() with as_frame=True) and stats maps the names
+        of learn_statistics/2 to their values, e.g. log_likelihood and num_iterations.
+        """
+        setting="".join(["set_prism_flag({},{}),".format(k,prolog_value(v)) for k,v in flags.items()])
+        main="{}$pyprism_ready,$pyprism_exec($pyprism_learn([{}]))".format(setting,",".join(LEARN_STATISTICS))
+        code=self.program(EXEC_DB+LEARN_DB, main, args)
+        res=self.run(code,args,areas,timeout,input=goal_lines(data, pred))
         if verbose:
             print("\n".join(self.result_stdout))
         if err_verbose:
             print("\n".join(self.result_stderr), file=sys.stderr)
+        if self.timed_out:
+            raise TimeoutError("PRISM learning did not finish in time")
+        msgs, status=parse_frames(res, 1)[0]
+        if status!="yes":
+            raise RuntimeError("PRISM learning failed: "+str(status)+"\n"+"\n".join(self.result_stdout[-3:]))
+        stats={}
+        switches=[]
+        parse=self.term_cache.parse_term if self.term_cache is not None else parse_term
+        with self.phase("parse"):
+            for r in parse_records("\n".join(msgs), raw=True):
+                if r[0]=="stat":
+                    stats[r[1]]=parse_record_value(r[2])
+                elif r[0]=="sw":
+                    sw={"name":"switch", "args":[parse(r[1]), r[2], parse(r[3]), parse(r[4])]}
+                    switches.append(sw_record(sw))
+            if as_frame:
+                from pyprism.df import sw_list2df
+                switches=sw_list2df(switches)
+        return switches, stats
+
+    def map(self, queries, workers=None, timeout=None, progress=None, **kwargs):
+        """Runs independent queries on a pool of PRISM processes
+
+        Each element of queries is a goal string or a dict of keyword arguments
+        of query(); kwargs are shared by all queries. Results are returned in
+        input order and a query that exceeds timeout seconds gives (None, "timeout").
+        progress(done, total) is called whenever a query finishes.
+        """
+        queries=[q if isinstance(q, dict) else {"q":q} for q in queries]
+        if workers is None:
+            workers=os.cpu_count() or 1
+        workers=max(1, min(workers, len(queries)))
+        if self.cache:
+            # compile once before the workers start loading the cached db
+            self.compiled_db(kwargs.get("args",[]))
+        # each worker has its own engine and working directory
+        pool=queue.Queue()
+        for i in range(workers):
+            worker=copy.copy(self)
+            worker.session=None
+            worker.wd_path=self.wd_path+"/worker-"+str(i)
+            pool.put(worker)
+        kwargs.setdefault("err_verbose", False)
+        kwargs.setdefault("timeout", timeout)
+        def run_task(q):
+            worker=pool.get()
+            try:
+                return worker.query(**{**kwargs, **q})
+            finally:
+                pool.put(worker)
+        results=[None]*len(queries)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures={executor.submit(run_task, q):i for i,q in enumerate(queries)}
+            for done, f in enumerate(concurrent.futures.as_completed(futures)):
+                results[futures[f]]=f.result()
+                if progress is not None:
+                    progress(done+1, len(queries))
+        return results
+
+    def program(self, clauses, main, args=[]):
+        """Builds a program from the db, extra clauses and the body of prism_main"""
+        with self.phase("program"):
+            stem=self.compiled_db(args) if self.cache else None
+            # PRISM reports its CPU time and memory usage around main
+            clauses=clauses+STAT_DB
+            if len(self.db_updates)>0:
+                clauses=clauses+UPDATE_DB
+                main=",".join(r"\+ \+ ({})".format(g) for g in self.db_updates)+",\n"+main
+            if stem is not None:
+                return clauses+"\n"+stat_main(main, "prism([load],"+quote_atom(stem)+"),")
+            return self.db+"\n"+clauses+"\n"+stat_main(main)
+
+    @contextlib.contextmanager
+    def metering(self, call):
+        """Collects the Metrics of a call; nested calls add to the outermost one"""
+        if self._metrics is not None:
+            yield self._metrics
+            return
+        m=Metrics(call)
+        self._metrics=m
+        t=time.perf_counter()
+        try:
+            yield m
+        finally:
+            m["total"]=time.perf_counter()-t
+            self._metrics=None
+            if self.result_stdout is not None:
+                m["prism"].update(parse_statistics(self.result_stdout))
+            self.last_metrics=m
+            logger.debug("%s: %s", call, m)
+            if self.metrics_hook is not None:
+                self.metrics_hook(m)
+
+    def phase(self, name):
+        if self._metrics is None:
+            return contextlib.nullcontext()
+        return self._metrics.phase(name)
+
+    def parse_result(self, out):
         if len(out)<7:
             return None, "error"
         open_msg=out[:7]
@@ -102,30 +664,313 @@ $find_n(Vars, Goal, M, Out):-
                 load_msg.append(el)
             else:
                 msgs.append(el)
-        if len(msgs)<3:
+        # a program that could not be loaded or was aborted by an exception
+        if len(msgs)<3 or msgs[-2] not in ["yes","no"]:
             return None, "error"
         return msgs[:-3], msgs[-2]
 
-    def run(self, code, args=[]):
-        now = dt.datetime.now()
-        os.makedirs(self.wd_path,exist_ok=True)
-        filename = self.wd_path+"/"+now.strftime('%Y%m%d-%H%M%S.psm')
-        with open(filename,"w") as fp:
-            fp.write(code)
-        return self.run_file(filename,args)
-
-    def run_file_(self,filename, args=[]):
-        cmd=self.bin_path+"/upprism"
-        cmds=[cmd, filename]+args
-        out=subprocess.run(cmds,timeout=None,stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-        return out
+    ### compiled-program cache
+    def cache_key(self, args=[]):
+        h=hashlib.sha256()
+        h.update(self.db.encode("utf8"))
+        h.update(b"\0"+os.path.abspath(self.bin_path).encode("utf8"))
+        h.update(b"\0"+repr(sorted(self.areas.items())).encode("utf8"))
+        h.update(b"\0"+"\0".join(args).encode("utf8"))
+        return h.hexdigest()
+
+    def compiled_db(self, args=[]):
+        """Returns the path (without extension) of the compiled db, compiling it on a cache miss"""
+        stem=os.path.abspath(self.cache_path+"/"+self.cache_key(args))
+        if os.path.exists(stem+".psm.out"):
+            os.utime(stem+".psm.out")
+            return stem
+        os.makedirs(self.cache_path,exist_ok=True)
+        # compiled under a name of its own and renamed when complete, so that
+        # other processes and threads never load a partly written entry
+        tmp=os.path.abspath("{}/{}{}-{}-{}".format(self.cache_path, CACHE_TMP_PREFIX, os.getpid(), threading.get_ident(), self.cache_key(args)))
+        try:
+            with open(tmp+".psm","w") as fp:
+                fp.write(self.db)
+            self.run("prism_main :-prism([compile],"+quote_atom(tmp)+").\n",args)
+            if not os.path.exists(tmp+".psm.out"):
+                return None
+            os.replace(tmp+".psm", stem+".psm")
+            # the .psm.out marks the entry as present
+            os.replace(tmp+".psm.out", stem+".psm.out")
+        finally:
+            for ext in [".psm",".psm.out"]:
+                if os.path.exists(tmp+ext):
+                    os.remove(tmp+ext)
+        self.evict_cache()
+        return stem
+
+    def evict_cache(self):
+        entries=[]
+        now=time.time()
+        for filename in glob.glob(self.cache_path+"/*.psm.out"):
+            stem=filename[:-len(".psm.out")]
+            if os.path.basename(stem).startswith(CACHE_TMP_PREFIX):
+                continue
+            try:
+                st=os.stat(filename)
+                size=st.st_size+os.path.getsize(stem+".psm")
+            except OSError:
+                continue
+            entries.append((st.st_mtime,size,stem))
+        entries.sort(reverse=True)
+        total=0
+        for mtime,size,stem in entries:
+            total+=size
+            if now-mtime>self.cache_max_age or total>self.cache_max_bytes:
+                for ext in [".psm",".psm.out"]:
+                    if os.path.exists(stem+ext):
+                        os.remove(stem+ext)
+
+    def clear_cache(self):
+        for filename in glob.glob(self.cache_path+"/*.psm")+glob.glob(self.cache_path+"/*.psm.out"):
+            os.remove(filename)
+
+    ### session mode: one long-lived PRISM process per engine
+    def start_session(self, args=[]):
+        self.stop_session()
+        self.session=PrismSession(self.bin_path, self.wd_path, self.session_code(), args=args, keep_files=self.keep_files, cmd=self.limit_resources(self.command()), cpu_limit=self.cpu_limit)
+        self.session.start()
+        self.session_updates=0
+        self.sync_session()
+        return self.session
+
+    def session_code(self):
+        return self.db+"\n"+FIND_N_DB+UPDATE_DB
+
+    def sync_session(self):
+        """Restarts the session if set_db() was called or PRISM exited, and
+        applies the updates of the db it has not seen yet"""
+        if self.session.code!=self.session_code():
+            self.start_session(self.session.args)
+            return
+        if not self.session.alive():
+            self.session.start()
+            self.session_updates=0
+        for goal in self.db_updates[self.session_updates:]:
+            msgs, status=self.session.query(goal, timeout=self.timeout)
+            if status!="yes":
+                raise RuntimeError("update failed: "+status+"\n"+"\n".join((self.session.result_stdout or [])+(self.session.result_stderr or [])))
+            self.session_updates+=1
+
+    def stop_session(self):
+        if self.session is not None:
+            self.session.close()
+            self.session=None
+
+    def query_session(self, q, verbose=False, err_verbose=True, timeout=None):
+        """Runs q in the session; returns (msgs, status) as a batch query does,
+        (None, "error") for a goal that raised an exception or could not be read"""
+        self.sync_session()
+        with self.phase("session"):
+            msgs, status=self.session.query(q, timeout=timeout if timeout is not None else self.timeout)
+        self.result_stdout=self.session.result_stdout
+        self.result_stderr=self.session.result_stderr
+        if verbose:
+            print("\n".join(self.result_stdout))
+        if err_verbose:
+            print("\n".join(self.result_stderr), file=sys.stderr)
+        return msgs, status
+
+    @metered("run")
+    def run(self, code, args=[], areas=None, timeout=None, input=None):
+        with self.phase("write"):
+            filename=self.program_file(code)
+        try:
+            return self.run_file(filename,args,areas,timeout,input)
+        finally:
+            with self.phase("cleanup"):
+                self.remove_program_file(filename)
+
+    def program_file(self, code):
+        return write_program(code, self.wd_path)
+
+    def remove_program_file(self, filename):
+        if not self.keep_files:
+            remove_program(filename)
+
+    def uses_launcher(self):
+        # only the upprism script is available: the memory areas are its own
+        return self.mp_procs is None and not os.path.exists(prism_binary(self.bin_path))
+
+    def command(self, areas=None):
+        """Command line of PRISM in batch mode with the given memory areas"""
+        mp=self.mp_procs is not None
+        binary=prism_binary(self.bin_path, mp)
+        if self.uses_launcher():
+            return [self.bin_path+"/upprism"]
+        areas={**self.areas, **(areas or {})}
+        cmds=[binary]
+        for k in ["parea","stack","trail","table"]:
+            cmds+=[AREA_OPTIONS[k], str(areas[k])]
+        if mp:
+            launcher=[el.format(procs=self.mp_procs) for el in self.mp_launcher]
+            return launcher+cmds+[self.bin_path+"/"+el for el in ["bp.out","prism.out","foc.out","mpprism.out"]]
+        return cmds+[self.bin_path+"/"+el for el in ["bp.out","prism.out","foc.out","batch.out"]]
 
-    def run_file(self, filename, args=[]):
-        r=self.run_file_(filename,args)
-        self.result_stdout=r.stdout.decode("utf8").split("\n")
-        self.result_stderr=r.stderr.decode("utf8").split("\n")
+    def grow_areas(self, areas, out, err, returncode):
+        """Returns larger areas if the run failed on an overflow, otherwise None"""
+        if self.uses_launcher():
+            # the sizes cannot be passed to upprism, so running again would not help
+            return None
+        area=overflow_area(out, err, returncode)
+        if area is None:
+            return None
+        areas={**self.areas, **(areas or {})}
+        grown=dict(areas)
+        grown[area]=min(areas[area]*2, max(self.max_areas.get(area,0), areas[area]))
+        if grown==areas:
+            return None
+        return grown
+
+    def limit_resources(self, cmds):
+        """cmds run under cpu_limit (seconds) and memory_limit (bytes)
+
+        The limits are set by a shell that then execs cmds, as a preexec_fn
+        is not safe while other threads run (map() uses a thread pool).
+        """
+        limits=[]
+        if self.cpu_limit is not None:
+            limits.append("ulimit -t {}".format(int(self.cpu_limit)))
+        if self.memory_limit is not None:
+            # in KiB
+            limits.append("ulimit -v {}".format(int(self.memory_limit)//1024))
+        if len(limits)==0:
+            return cmds
+        return ["/bin/sh", "-c", "; ".join(limits)+'; exec "$@"', "sh"]+cmds
+
+    def run_file_(self,filename, args=[], areas=None, timeout=None, input=None):
+        """Runs PRISM in its own process group; returns (CompletedProcess, timed_out)
+
+        input is an iterable of lines written to the standard input of PRISM
+        """
+        cmds=self.command(areas)+[filename]+args
+        timeout=timeout if timeout is not None else self.timeout
+        with self.phase("spawn"):
+            proc=subprocess.Popen(self.limit_resources(cmds), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    stdin=subprocess.PIPE if input is not None else None,
+                    start_new_session=True)
+        if input is not None:
+            with self.phase("process"):
+                stdout, stderr, timed_out=communicate(proc, input, timeout)
+            return subprocess.CompletedProcess(cmds, proc.returncode, stdout, stderr), timed_out
+        timed_out=False
+        try:
+            with self.phase("process"):
+                stdout, stderr=proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out=True
+        except BaseException:
+            kill_process_group(proc)
+            proc.communicate()
+            raise
+        if timed_out:
+            kill_process_group(proc)
+            # output written before the deadline
+            stdout, stderr=proc.communicate()
+        # a process killed by RLIMIT_CPU also ran out of time
+        if proc.returncode in [-signal.SIGXCPU, -signal.SIGKILL] and self.cpu_limit is not None:
+            timed_out=True
+        return subprocess.CompletedProcess(cmds, proc.returncode, stdout, stderr), timed_out
+
+    def run_file(self, filename, args=[], areas=None, timeout=None, input=None):
+        # input can only be sent again if it is a sequence
+        retry=input is None or isinstance(input, (list, tuple))
+        while True:
+            r, self.timed_out=self.run_file_(filename,args,areas,timeout,input)
+            with self.phase("decode"):
+                self.result_stdout=r.stdout.decode("utf8").split("\n")
+                self.result_stderr=split_stats(r.stderr.decode("utf8").split("\n"), self._metrics)
+            grown=None if self.timed_out or not retry else self.grow_areas(areas, self.result_stdout, self.result_stderr, r.returncode)
+            if grown is None:
+                break
+            areas=grown
+        self.last_areas={**self.areas, **(areas or {})}
         return self.result_stdout
 
+    ### asyncio interface
+    async def aquery(self, q, find_n=None, findall=False, out=None, err_verbose=True, verbose=False,args=[], areas=None, timeout=None):
+        q, find_n_db=self.build_query(q, find_n=find_n, findall=findall, out=out)
+        if verbose:
+            print("new query:",q)
+        if self.cache:
+            # compiling on a cache miss runs PRISM synchronously
+            loop=asyncio.get_running_loop()
+            code=await loop.run_in_executor(None, self.program, find_n_db, q, args)
+        else:
+            code=self.program(find_n_db, q, args)
+        out, err, timed_out=await self.arun_(code,args,areas,timeout)
+        if verbose:
+            print("\n".join(out))
+        if err_verbose:
+            print("\n".join(err), file=sys.stderr)
+        if timed_out:
+            return None, "timeout"
+        return self.parse_result(out)
+
+    async def arun(self, code, args=[], areas=None, timeout=None):
+        out, err, timed_out=await self.arun_(code, args, areas, timeout)
+        return out
+
+    async def arun_(self, code, args=[], areas=None, timeout=None):
+        filename=self.program_file(code)
+        try:
+            return await self.arun_file_(filename,args,areas,timeout)
+        finally:
+            self.remove_program_file(filename)
+
+    async def arun_file(self, filename, args=[], areas=None, timeout=None):
+        out, err, timed_out=await self.arun_file_(filename, args, areas, timeout)
+        return out
+
+    async def arun_file_(self, filename, args=[], areas=None, timeout=None):
+        while True:
+            out, err, timed_out, returncode=await self.arun_file_once(filename, args, areas, timeout)
+            grown=None if timed_out else self.grow_areas(areas, out, err, returncode)
+            if grown is None:
+                return out, err, timed_out
+            areas=grown
+
+    async def arun_file_once(self, filename, args=[], areas=None, timeout=None):
+        cmds=self.command(areas)+[filename]+args
+        timeout=timeout if timeout is not None else self.timeout
+        async with self.semaphore():
+            proc=await asyncio.create_subprocess_exec(*self.limit_resources(cmds), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True)
+            stdout=asyncio.ensure_future(proc.stdout.read())
+            stderr=asyncio.ensure_future(proc.stderr.read())
+            timed_out=False
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                timed_out=True
+                kill_process_group(proc)
+                await proc.wait()
+            except BaseException:
+                # cancelled: do not leave PRISM running
+                kill_process_group(proc)
+                await proc.wait()
+                stdout.cancel()
+                stderr.cancel()
+                raise
+            stdout, stderr=await stdout, await stderr
+        if proc.returncode in [-signal.SIGXCPU, -signal.SIGKILL] and self.cpu_limit is not None:
+            timed_out=True
+        self.result_stdout=stdout.decode("utf8").split("\n")
+        self.result_stderr=split_stats(stderr.decode("utf8").split("\n"))
+        return self.result_stdout, self.result_stderr, timed_out, proc.returncode
+
+    def semaphore(self):
+        loop=asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            n=self.max_concurrency or os.cpu_count() or 1
+            self._semaphore=(loop, asyncio.Semaphore(n))
+        return self._semaphore[1]
+
 PRISMEngine = PrismEngine # compatibility
 
 def main():
@@ -1,18 +1,37 @@
 import os
 import glob
+import tempfile
 import subprocess
 import datetime as dt
 import argparse
 import typing as t
 
-def run(code, args=[]):
-    prism_wd_path = './.prism_code/'
+def write_program(code, wd_path, prefix=""):
+    """Writes code to a new uniquely named .psm file in wd_path"""
     now = dt.datetime.now()
-    os.makedirs(prism_wd_path,exist_ok=True)
-    filename = prism_wd_path+now.strftime('%Y%m%d-%H%M%S.psm')
-    with open(filename,"w") as fp:
+    os.makedirs(wd_path,exist_ok=True)
+    # calls in the same second (threads, processes) must not share a file
+    fd, filename = tempfile.mkstemp(prefix=prefix+now.strftime('%Y%m%d-%H%M%S-'), suffix=".psm", dir=wd_path)
+    with os.fdopen(fd,"w") as fp:
         fp.write(code)
-    return run_file(filename,args)
+    return filename
+
+def remove_program(filename):
+    """Removes a program file and the byte code PRISM compiled from it"""
+    for f in [filename, filename+".out"]:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+
+def run(code, args=[], keep_files=False):
+    prism_wd_path = './.prism_code/'
+    filename = write_program(code, prism_wd_path)
+    try:
+        return run_file(filename,args)
+    finally:
+        if not keep_files:
+            remove_program(filename)
 
 def run_file_(filename, args=[]):
     path=os.path.dirname(__file__)
@@ -0,0 +1,100 @@
+import re
+import time
+import logging
+import contextlib
+
+logger=logging.getLogger("pyprism")
+
+STAT_MARK="$pyprism_stat"
+
+# reports the CPU time used by PRISM (ms) and its memory usage on stderr
+STAT_DB="""
+$pyprism_stat(P):-statistics(runtime,[T,_]),
+    format(user_error,"$pyprism_stat ~w runtime ~w~n",[P,T]).
+$pyprism_stat_memory:-
+    ( member(K,[program,heap,control,trail,table]),catch(statistics(K,[U,_]),_,fail),
+      format(user_error,"$pyprism_stat end ~w ~w~n",[K,U]),
+      fail
+    ; true ).
+"""
+
+def stat_main(main, before=""):
+    """Clauses of prism_main running before and then main, with PRISM reporting
+    its statistics around main
+
+    main is compiled as the clause of $pyprism_main/0 (a goal called through
+    catch/3 would be interpreted, and behave and perform differently).
+    """
+    return """$pyprism_main :- {}.
+prism_main :-{}$pyprism_stat(start),
+    ( catch($pyprism_main,E_,($pyprism_stat(end),$pyprism_stat_memory,throw(E_))) ->
+        $pyprism_stat(end),$pyprism_stat_memory
+    ; $pyprism_stat(end),$pyprism_stat_memory,fail ).
+""".format(main, before)
+
+class Metrics(dict):
+    """Timing of one engine call
+
+    phases maps the name of each phase (build, program, write, spawn, process,
+    decode, parse, ...) to seconds; prism holds what PRISM reported itself:
+    load_cpu/exec_cpu (seconds of CPU time before and in prism_main), memory
+    in use (*_bytes) and the items of "Statistics on ..." blocks (e.g. graph_size).
+    """
+    def __init__(self, call):
+        super().__init__(call=call, total=0.0, phases={}, prism={})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t=time.perf_counter()
+        try:
+            yield
+        finally:
+            self["phases"][name]=self["phases"].get(name,0.0)+time.perf_counter()-t
+
+def split_stats(lines, metrics=None):
+    """Removes the statistics lines of STAT_DB from the stderr lines of PRISM and
+    stores their values in metrics"""
+    rest=[]
+    runtime={}
+    for line in lines:
+        if not line.startswith(STAT_MARK):
+            rest.append(line)
+            continue
+        if metrics is None:
+            continue
+        _, point, key, value=line.split(" ")
+        if key=="runtime":
+            runtime[point]=int(value)/1000.0
+        else:
+            metrics["prism"][key+"_bytes"]=int(value)
+    if metrics is not None and "start" in runtime:
+        metrics["prism"]["load_cpu"]=runtime["start"]
+        if "end" in runtime:
+            metrics["prism"]["exec_cpu"]=runtime["end"]-runtime["start"]
+    return rest
+
+STAT_LINE_PATTERN=re.compile(r'^\s+([A-Za-z][A-Za-z #\-]*):\s+(-?[\d\.e\+\-]+)')
+
+def parse_statistics(lines):
+    """Collects the items of the "Statistics on ..." blocks printed by PRISM
+    (e.g. "Graph size: 3" gives {"graph_size": 3})"""
+    stats={}
+    in_block=False
+    for line in lines:
+        if line.startswith("Statistics on"):
+            in_block=True
+            continue
+        m=STAT_LINE_PATTERN.match(line) if in_block else None
+        if m is None:
+            in_block=False
+            continue
+        key=re.sub(r'[^a-z0-9]+','_',m.group(1).strip().lower()).strip("_")
+        try:
+            value=int(m.group(2))
+        except ValueError:
+            try:
+                value=float(m.group(2))
+            except ValueError:
+                continue
+        stats[key]=value
+    return stats
@@ -1,22 +1,27 @@
 import re
 import json
+import collections
+import concurrent.futures
+
+TOKEN_SPECIFICATION = [
+    ('STRING',  r'\"(\\.|[^"\\])*\"|\'(\\.|[^\'\\])*\''),
+    ('OP',      r'[\+\-\*/=><:]+'),  # 演算子
+    ('NUMBER',  r'(?:\d+\.\d*|\.\d+|\d+)(?:[eE][\+\-]?\d+)?'),  # 小数 or 整数
+    ('NAME',    r'[A-Za-z_][A-Za-z0-9_]*'),
+    ('COMMA',   r','),
+    ('LPAREN',  r'\('),
+    ('RPAREN',  r'\)'),
+    ('LBRACK',  r'\['),
+    ('RBRACK',  r'\]'),
+    ('SKIP',    r'\s+'),
+    ('OTHER',   r' '),
+]
+TOKEN_REGEX = re.compile('|'.join(f'(?P<{name}>{regex})' for name, regex in TOKEN_SPECIFICATION))
+# the same tokens with the white space before each one included in its match
+FAST_TOKEN_REGEX = re.compile(r'\s*(?:' + '|'.join(f'(?P<{name}>{regex})' for name, regex in TOKEN_SPECIFICATION[:-2]) + ')')
 
 def tokenize(s):
-    token_specification = [
-        ('STRING',  r'\"(\\.|[^"\\])*\"|\'(\\.|[^\'\\])*\''),
-        ('OP',      r'[\+\-\*/=><:]+'),  # 演算子
-        ('NUMBER',  r'(?:\d+\.\d*|\.\d+|\d+)(?:[eE][\+\-]?\d+)?'),  # 小数 or 整数
-        ('NAME',    r'[A-Za-z_][A-Za-z0-9_]*'),
-        ('COMMA',   r','),
-        ('LPAREN',  r'\('),
-        ('RPAREN',  r'\)'),
-        ('LBRACK',  r'\['),
-        ('RBRACK',  r'\]'),
-        ('SKIP',    r'\s+'),
-        ('OTHER',   r' '),
-    ]
-    tok_regex = '|'.join(f'(?P<{name}>{regex})' for name, regex in token_specification)
-    for mo in re.finditer(tok_regex, s):
+    for mo in TOKEN_REGEX.finditer(s):
         kind = mo.lastgroup
         value = mo.group()
         if kind == 'SKIP':
@@ -169,9 +174,149 @@ def parse_args(ts, end_kind):
             items.append(parse_expr(ts))
     return items
 
+# frames of TermParser.expr
+_UNARY, _BINOP, _ARGS, _TUPLE = range(4)
+# the node of an _ARGS frame that has just been opened
+_NO_ITEM = object()
+
+class TermParser:
+    """Parser of parse_term reading the tokens of s one at a time
+
+    Same grammar as parse_expr/parse_atom/parse_args, but the lexer is
+    compiled once, the current token is kept in kind/value instead of a
+    list of tuples, and nested terms are parsed with an explicit stack
+    (no recursion limit on the depth of terms).
+    """
+    __slots__ = ('_next', 'kind', 'value')
+
+    def __init__(self, s):
+        self._next = FAST_TOKEN_REGEX.finditer(s).__next__
+        self.advance()
+
+    def advance(self):
+        try:
+            mo = self._next()
+        except StopIteration:
+            self.kind = self.value = None
+            return
+        self.kind = kind = mo.lastgroup
+        self.value = mo.group(kind)
+
+    def expr(self, min_prec=0):
+        advance = self.advance
+        # frames waiting for the expression being parsed:
+        # (_UNARY, op, min_prec), (_BINOP, op, left, min_prec),
+        # [_ARGS, end_kind, items, name, min_prec], [_TUPLE, items, min_prec]
+        stack = []
+        while True:
+            ### the beginning of an expression: parse its first operand
+            kind = self.kind
+            value = self.value
+            binary = True
+            if kind is None:
+                raise SyntaxError("Unexpected end of input")
+            elif kind == 'OP' and value in PREFIX_OPS:
+                advance()
+                kind = self.kind
+                if kind is None or kind == 'COMMA' or kind == 'RPAREN' or kind == 'RBRACK':
+                    # a nullary operator ends the expression
+                    node = {'nullary': value}
+                    binary = False
+                else:
+                    stack.append((_UNARY, value, min_prec))
+                    min_prec = PRECEDENCE[value]
+                    continue
+            elif kind == 'NAME' or kind == 'STRING':
+                advance()
+                if self.kind == 'LPAREN':
+                    advance()
+                    stack.append([_ARGS, 'RPAREN', [], value, min_prec])
+                    node = _NO_ITEM
+                    binary = False
+                else:
+                    node = value
+            elif kind == 'NUMBER':
+                advance()
+                node = float(value) if '.' in value or 'e' in value.lower() else int(value)
+            elif kind == 'LPAREN':
+                advance()
+                stack.append([_TUPLE, [], min_prec])
+                min_prec = 0
+                continue
+            elif kind == 'LBRACK':
+                advance()
+                stack.append([_ARGS, 'RBRACK', [], None, min_prec])
+                node = _NO_ITEM
+                binary = False
+            else:
+                raise SyntaxError(f'Unexpected token: {(kind, value)}')
+            ### complete the frames until one needs another expression
+            while True:
+                if binary:
+                    # binary operators following node
+                    if self.kind == 'OP':
+                        op = self.value
+                        prec = PRECEDENCE.get(op)
+                        if prec is not None and prec >= min_prec:
+                            advance()
+                            stack.append((_BINOP, op, node, min_prec))
+                            min_prec = prec + 1
+                            break
+                if not stack:
+                    return node
+                frame = stack[-1]
+                tag = frame[0]
+                if tag == _UNARY:
+                    stack.pop()
+                    node = {'unary': frame[1], 'expr': node}
+                    min_prec = frame[2]
+                    binary = True
+                elif tag == _BINOP:
+                    stack.pop()
+                    node = {'binop': frame[1], 'left': frame[2], 'right': node}
+                    min_prec = frame[3]
+                    binary = True
+                elif tag == _ARGS:
+                    items = frame[2]
+                    if node is not _NO_ITEM:
+                        items.append(node)
+                    end_kind = frame[1]
+                    kind = self.kind
+                    while kind == 'COMMA':
+                        advance()
+                        kind = self.kind
+                    if kind == end_kind:
+                        advance()
+                        stack.pop()
+                        node = items if frame[3] is None else {'name': frame[3], 'args': items}
+                        min_prec = frame[4]
+                        binary = True
+                    elif kind is None:
+                        raise SyntaxError(f'Unclosed {end_kind}')
+                    else:
+                        min_prec = 0
+                        break
+                else:
+                    items = frame[1]
+                    items.append(node)
+                    kind = self.kind
+                    if kind == 'COMMA':
+                        advance()
+                        min_prec = 0
+                        break
+                    elif kind == 'RPAREN':
+                        advance()
+                        stack.pop()
+                        node = items[0] if len(items) == 1 else {'tuple': items}
+                        min_prec = frame[2]
+                        binary = True
+                    elif kind is None:
+                        raise SyntaxError("Unclosed ')'")
+                    else:
+                        raise SyntaxError(f"Unexpected token in tuple or paren: {(kind, self.value)}")
+
 def parse_term(s):
-    tokens = TokenStream(tokenize(s))
-    return parse_expr(tokens)
+    return TermParser(s).expr()
 
 def parse_output_(obj):
     if isinstance(obj, dict) and 'binop' in obj:
@@ -189,72 +334,315 @@ def parse_output(s):
         if isinstance(obj, dict) and 'binop' in obj:
             return [parse_output_(obj)]
 
-def serialize_term(obj, unary_op_paren=True, binary_op_paren=True):
-    name_pattern=re.compile(r'^[A-Za-z_][A-Za-z_0-9]*$')
-    if isinstance(obj, dict) and 'name' in obj:
-        # function
-        func = obj['name']
-        args = ','.join(serialize_term(arg) for arg in obj['args'])
-        return f"{func}({args})"
-    if isinstance(obj, dict) and 'nullary' in obj:
-        # nullary op
-        name = obj["nullary"]
-        return f"{name}"
-    if isinstance(obj, dict) and 'unary' in obj:
-        # unary op
-        name = obj["unary"]
-        expr = serialize_term(obj["expr"])
-        if unary_op_paren:
-            return f"({name}{expr})"
-        else:
-            return f"{name}{expr}"
-    if isinstance(obj, dict) and 'binop' in obj:
-        # binary op
-        name = obj["binop"]
-        lhs = serialize_term(obj["left"])
-        rhs = serialize_term(obj["right"])
-        if binary_op_paren:
-            return f"({lhs}{name}{rhs})"
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+class TermCache:
+    """LRU cache of parse_term, parse_output and serialize_term results
+
+    At most maxsize results are kept (the least recently used one is evicted)
+    and texts longer than max_length characters are not cached. Parsed terms
+    are stored as JSON and rebuilt on each hit, so the returned terms are
+    never shared between callers and can be modified freely.
+    """
+    def __init__(self, maxsize=4096, max_length=4096):
+        self.maxsize=maxsize
+        self.max_length=max_length
+        self.items=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def get(self, key):
+        v=self.items.get(key)
+        if v is None:
+            self.misses+=1
         else:
-            return f"{lhs}{name}{rhs}"
-    if isinstance(obj, dict) and 'tuple' in obj:
-        # tuple
-        return '(' + ','.join(serialize_term(item) for item in obj["tuple"]) + ')'
-    elif isinstance(obj, list):
-        return '[' + ','.join(serialize_term(item) for item in obj) + ']'
-    elif isinstance(obj, str):
-      if name_pattern.match(obj):
+            self.items.move_to_end(key)
+            self.hits+=1
+        return v
+
+    def put(self, key, v):
+        self.items[key]=v
+        if len(self.items)>self.maxsize:
+            self.items.popitem(last=False)
+            self.evictions+=1
+
+    def parse_term(self, s):
+        if len(s)>self.max_length:
+            return parse_term(s)
+        key=('t', s)
+        v=self.get(key)
+        if v is not None:
+            return json.loads(v)
+        obj=parse_term(s)
+        try:
+            self.put(key, json.dumps(obj))
+        except RecursionError:
+            # too deep to be rebuilt by json; not cached
+            pass
         return obj
-      else:
-        # 文字列はクォート（デフォルトはダブル）
-        return '"' + obj.replace('"', '\\"') + '"'
-    elif isinstance(obj, (int, float)):
-        return str(obj)
+
+    def parse_output(self, s):
+        if len(s)>self.max_length:
+            return parse_output(s)
+        key=('o', s)
+        v=self.get(key)
+        if v is None:
+            v=parse_output(s)
+            v=(tuple(v) if v is not None else None,)
+            self.put(key, v)
+        # a new list of (name, value) tuples of strings
+        return list(v[0]) if v[0] is not None else None
+
+    def serialize_term(self, obj, unary_op_paren=True, binary_op_paren=True):
+        if isinstance(obj, str) and len(obj)<=self.max_length:
+            key=('s', obj, unary_op_paren, binary_op_paren)
+        else:
+            try:
+                k=json.dumps(obj)
+            except (RecursionError, TypeError, ValueError):
+                k=None
+            if k is None or len(k)>self.max_length:
+                return serialize_term(obj, unary_op_paren, binary_op_paren)
+            key=('j', k, unary_op_paren, binary_op_paren)
+        v=self.get(key)
+        if v is None:
+            v=serialize_term(obj, unary_op_paren, binary_op_paren)
+            self.put(key, v)
+        return v
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.items))
+
+    def clear(self):
+        self.items.clear()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+NAME_PATTERN=re.compile(r'^[A-Za-z_][A-Za-z_0-9]*$')
+
+class _Piece(str):
+    # text written after the parts of a term (serialize_term)
+    __slots__ = ()
+
+_COMMA_PIECE = _Piece(',')
+_RPAREN_PIECE = _Piece(')')
+_RBRACK_PIECE = _Piece(']')
+
+def serialize_term(obj, unary_op_paren=True, binary_op_paren=True):
+    """Converts a term parsed by parse_term back to text
+
+    The options apply to the outermost operator; nested operators are always
+    put in parentheses. Terms are walked with an explicit stack and the text
+    is joined once, so deep terms take linear time.
+    """
+    out=[]
+    stack=[obj]
+    while stack:
+        obj=stack.pop()
+        if type(obj) is _Piece:
+            out.append(obj)
+            continue
+        if isinstance(obj, dict) and 'name' in obj:
+            # function
+            out.append(f"{obj['name']}(")
+            stack.append(_RPAREN_PIECE)
+            push_items(stack, obj['args'])
+        elif isinstance(obj, dict) and 'nullary' in obj:
+            # nullary op
+            out.append(f"{obj['nullary']}")
+        elif isinstance(obj, dict) and 'unary' in obj:
+            # unary op
+            if unary_op_paren:
+                out.append(f"({obj['unary']}")
+                stack.append(_RPAREN_PIECE)
+            else:
+                out.append(f"{obj['unary']}")
+            stack.append(obj["expr"])
+        elif isinstance(obj, dict) and 'binop' in obj:
+            # binary op
+            if binary_op_paren:
+                out.append("(")
+                stack.append(_RPAREN_PIECE)
+            stack.append(obj["right"])
+            stack.append(_Piece(obj["binop"]))
+            stack.append(obj["left"])
+        elif isinstance(obj, dict) and 'tuple' in obj:
+            # tuple
+            out.append('(')
+            stack.append(_RPAREN_PIECE)
+            push_items(stack, obj["tuple"])
+        elif isinstance(obj, list):
+            out.append('[')
+            stack.append(_RBRACK_PIECE)
+            push_items(stack, obj)
+        elif isinstance(obj, str):
+            if NAME_PATTERN.match(obj):
+                out.append(obj)
+            else:
+                # 文字列はクォート（デフォルトはダブル）
+                out.append('"' + obj.replace('"', '\\"') + '"')
+        elif isinstance(obj, (int, float)):
+            out.append(str(obj))
+        else:
+            raise TypeError(f"Unsupported type: {type(obj)}")
+        # the options only apply to the outermost term
+        unary_op_paren=binary_op_paren=True
+    return ''.join(out)
+
+def push_items(stack, items):
+    # items separated by commas, the first one on top
+    if not isinstance(items, (list, tuple, str)):
+        items=list(items)
+    n=len(items)
+    for i in range(n-1, -1, -1):
+        stack.append(items[i])
+        if i>0:
+            stack.append(_COMMA_PIECE)
+
+RECORD_PATTERN=re.compile('\x02([^\x03]*)\x03')
+INT_PATTERN=re.compile(r'^-?\d+$')
+FLOAT_PATTERN=re.compile(r'^-?\d+\.\d+(?:e[\+\-]?\d+)?$')
+QUOTE_ESCAPE_PATTERN=re.compile(r"\\(.)|''")
+QUOTE_ESCAPES={'n':'\n','t':'\t','\\':'\\',"'":"'",'"':'"','`':'`','a':'\a','b':'\b','f':'\f','v':'\v','r':'\r','0':'\0'}
+
+def parse_record_value(s):
+    """Converts a writeq-ed value: numbers to int/float, quoted atoms to plain strings;
+    compound terms and variables are kept as their text"""
+    if INT_PATTERN.match(s):
+        return int(s)
+    if FLOAT_PATTERN.match(s):
+        return float(s)
+    if len(s)>=2 and s[0]=="'" and s[-1]=="'":
+        return QUOTE_ESCAPE_PATTERN.sub(lambda m: QUOTE_ESCAPES.get(m.group(1),m.group(1)) if m.group(1) is not None else "'", s[1:-1])
+    return s
+
+def parse_records(s, raw=False):
+    """Parses all records written by $pyprism_rec/1 in the PRISM output s
+    (with raw=True the fields are kept as the text written by PRISM)"""
+    if raw:
+        return [r.split('\x1f') for r in RECORD_PATTERN.findall(s)]
+    return [[parse_record_value(v) for v in r.split('\x1f')] for r in RECORD_PATTERN.findall(s)]
+
+def parse_record_columns(s, n):
+    """The fields of the records of s with n fields each as n columns of raw text
+
+    The records are split all at once and the columns are sliced from the
+    flat list of fields, so no list is made per record.
+    """
+    records=RECORD_PATTERN.findall(s)
+    fields="\x1f".join(records).split("\x1f") if len(records)>0 else []
+    if len(fields)!=len(records)*n:
+        # a field contains the separator or a record has another size
+        rows=[r.split('\x1f') for r in records]
+        if any(len(r)!=n for r in rows):
+            raise ValueError("records do not have {} fields".format(n))
+        return [[r[i] for r in rows] for i in range(n)]
+    return [fields[i::n] for i in range(n)]
+
+def sw_record(sw):
+  """Converts a parsed switch(Sw,Status,Values,Params) term to a switch record"""
+  obj=sw["args"][0]
+  return {"term":serialize_term(obj),
+          "term_obj":obj,
+          "status":sw["args"][1],
+          "values":sw["args"][2],
+          "params":sw["args"][3]}
+
+# quoted atoms/strings, comments and clause ends ('.' followed by white space)
+CLAUSE_PATTERN=re.compile(r'''"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|%[^\n]*|/\*.*?\*/|\.(?=\s)''', re.S)
+
+def iter_clauses(fp, block_size=1<<20):
+  """Yields the text of each clause (without its final '.' and comments) read from fp;
+  clauses may span several lines"""
+  pieces=[]
+  rest=""
+  while True:
+    block=fp.read(block_size)
+    if block=="":
+      # the last clause may end without a newline
+      text=rest+"\n"
     else:
-        raise TypeError(f"Unsupported type: {type(obj)}")
-
-def read_sw(filename):
-  sw_list=[]
-  for line in open(filename):
-    l=line.strip()
-    if len(l)>0:
-      sw=parse_term(l[:-1])
-      if sw["name"]=="switch":
-        obj=sw["args"][0]
-        s=serialize_term(obj)
-        status=sw["args"][1]
-        values=sw["args"][2]
-        params=sw["args"][3]
-        
-        sw_list.append({"term":s,
-                        "term_obj":obj,
-                        "status":status,
-                        "values":values,
-                        "params":params})
-  return sw_list
-
-def read_sw_data(filename,use_array=False):
-  sw_list=read_sw(filename)
+      # complete lines only: a clause end needs the character after the '.'
+      text=rest+block
+      end=text.rfind("\n")+1
+      text, rest=text[:end], text[end:]
+    start=0
+    for m in CLAUSE_PATTERN.finditer(text):
+      c=text[m.start()]
+      if c==".":
+        pieces.append(text[start:m.start()])
+        clause="".join(pieces).strip()
+        pieces=[]
+        if len(clause)>0:
+          yield clause
+        start=m.end()
+      elif c=="%" or c=="/":
+        pieces.append(text[start:m.start()])
+        start=m.end()
+    pieces.append(text[start:])
+    if block=="":
+      clause="".join(pieces).strip()
+      if len(clause)>0:
+        yield clause
+      return
+
+def switch_term(clause):
+  """The parsed switch(Sw,Status,Values,Params) term of a clause, or None for other clauses"""
+  sw=parse_term(clause)
+  if isinstance(sw, dict) and sw.get("name")=="switch" and len(sw["args"])==4:
+    return sw
+  return None
+
+def parse_switches(clauses):
+  return [sw for sw in map(switch_term, clauses) if sw is not None]
+
+def chunked(it, n):
+  chunk=[]
+  for x in it:
+    chunk.append(x)
+    if len(chunk)>=n:
+      yield chunk
+      chunk=[]
+  if len(chunk)>0:
+    yield chunk
+
+def iter_sw_terms(filename, processes=None, chunk_size=2000):
+  """Yields the switch terms of a .sw file in order
+
+  With processes>1 chunks of chunk_size clauses are parsed in that many
+  processes, with at most 2*processes chunks in flight.
+  """
+  with open(filename) as fp:
+    if processes is None or processes<=1:
+      for clause in iter_clauses(fp):
+        sw=switch_term(clause)
+        if sw is not None:
+          yield sw
+      return
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+      pending=collections.deque()
+      try:
+        for chunk in chunked(iter_clauses(fp), chunk_size):
+          pending.append(executor.submit(parse_switches, chunk))
+          if len(pending)>=2*processes:
+            yield from pending.popleft().result()
+        while pending:
+          yield from pending.popleft().result()
+      finally:
+        for f in pending:
+          f.cancel()
+
+def iter_sw(filename, processes=None, chunk_size=2000):
+  """Yields the switch records of a .sw file one at a time (see read_sw)"""
+  for sw in iter_sw_terms(filename, processes, chunk_size):
+    yield sw_record(sw)
+
+def read_sw(filename, processes=None, chunk_size=2000):
+  return list(iter_sw(filename, processes, chunk_size))
+
+def sw_data(sw_list,use_array=False):
   #[Name	Arity	Term	Status	Vals	Param	Arg1	Arg2	Arg3	Arg4	Arg5]
   data=[]
   for el in sw_list:
@@ -269,8 +657,17 @@ def read_sw_data(filename,use_array=False):
   n_arg=max(max([len(args) for line,args in data]),5)
   return data,n_arg
 
-def sw2tsv(filename,out_filename):
-  data,m = read_sw_data(filename)
+def read_sw_data(filename,use_array=False,processes=None,cache=None):
+  """The rows of sw_data for a .sw file; with cache (a swtable.SwitchTableCache,
+  or True for one next to the file) the parsed switches are kept on disk"""
+  if cache is not None and cache is not False:
+    from pyprism.swtable import SwitchTableCache
+    cache=SwitchTableCache() if cache is True else cache
+    return cache.load(filename,processes).sw_data(use_array)
+  return sw_data(iter_sw(filename,processes),use_array)
+
+def sw2tsv(filename,out_filename,cache=None):
+  data,m = read_sw_data(filename,cache=cache)
   with open(out_filename,"w") as ofp:
     h1=["Name","Arity","Term","Status","Vals","Param"]
     h2=["Arg"+str(i+1) for i in range(m)]
@@ -0,0 +1,74 @@
+import re
+import numpy as np
+import pandas as pd
+from pyprism.parser import parse_record_value, INT_PATTERN
+
+# typed DataFrames of query records (PrismEngine.query_df), without the
+# sklearn and matplotlib imports of df
+
+
+def record_columns2df(cols, columns):
+    """Columns of raw record values (parse_record_columns) to a DataFrame with typed columns
+
+    Columns of integers become int64 (Int64 if some values are unbound
+    variables), columns of numbers float64 and the other columns strings:
+    atoms unquoted and compound terms as written by PRISM. Unbound
+    variables are missing values. Each column is checked with one regular
+    expression over its whole text before it is converted.
+    """
+    frame = pd.DataFrame({i: _record_column(v) for i, v in enumerate(cols)}, columns=range(len(columns)))
+    frame.columns = columns
+    return frame
+
+
+# characters outside the writeq text of integers and of numbers; a column
+# without them is converted with int()/float() (terms like 1-2 fail there)
+NOT_INT = re.compile(r"[^\d\n\-]")
+NOT_NUM = re.compile(r"[^\d\n\-\+\.e]")
+NUM_VAR_COLUMN = re.compile(r"(?:(?:_\w*|{0})\n)*(?:_\w*|{0})".format(r"-?\d+(?:\.\d+(?:e[\+\-]?\d+)?)?"))
+# values that parse_record_value changes (and variables)
+CONVERTED_VALUE = re.compile(r"^['_\-\d]", re.M)
+
+
+def _record_column(values):
+    n = len(values)
+    if n == 0:
+        return pd.Series([], dtype=object)
+    text = "\n".join(values)
+    # integers out of the int64 range are kept as Python ints
+    big = False
+    try:
+        if NOT_INT.search(text) is None:
+            return pd.Series(np.fromiter(map(int, values), dtype=np.int64, count=n))
+    except ValueError:
+        pass
+    except OverflowError:
+        big = True
+    try:
+        if not big and NOT_NUM.search(text) is None:
+            return pd.Series(np.fromiter(map(float, values), dtype=np.float64, count=n))
+    except ValueError:
+        pass
+    if not big and "_" in text and NUM_VAR_COLUMN.fullmatch(text):
+        # numbers with unbound variables
+        var = np.fromiter((v[0] == "_" for v in values), dtype=bool, count=n)
+        if var.all():
+            return pd.Series([None] * n, dtype=object)
+        nums = ["0" if v[0] == "_" else v for v in values]
+        if all(INT_PATTERN.match(v) for v in nums):
+            try:
+                ints = np.fromiter(map(int, nums), dtype=np.int64, count=n)
+                return pd.Series(pd.arrays.IntegerArray(ints, var))
+            except OverflowError:
+                pass
+        else:
+            floats = np.fromiter(map(float, nums), dtype=np.float64, count=n)
+            floats[var] = np.nan
+            return pd.Series(floats)
+    if CONVERTED_VALUE.search(text) is None:
+        # only unquoted atoms and terms
+        return pd.Series(values, dtype=object)
+    # quoted atoms, variables and numbers mixed with atoms and terms,
+    # converted once per distinct value
+    conv = {v: None if v[0] == "_" else parse_record_value(v) if v[0] in "'-0123456789" else v for v in set(values)}
+    return pd.Series([conv[v] for v in values], dtype=object)
@@ -0,0 +1,223 @@
+import os
+import signal
+import subprocess
+import threading
+from pyprism.main import write_program, remove_program
+
+# the marks start with SOH so that output of the program cannot be taken for them
+READY_MARK="\x01$pyprism_ready"
+END_MARK="\x01$pyprism_end"
+
+# run a goal and frame its output with an end marker and its status;
+# $pyprism_rec/1 writes one record framed by STX/ETX with fields separated by US
+EXEC_DB="""
+$pyprism_ready:-put_code(1),write('$pyprism_ready'),nl.
+$pyprism_end:-nl,put_code(1),write('$pyprism_end').
+$pyprism_exec(G):-nonvar(G),G=$pyprism_syntax_error(E),!,
+    $pyprism_end,write(' Aborted by exception -- '),write(E),nl.
+$pyprism_exec(G):-
+    ( catch(G,E,true) ->
+        ( var(E) -> Status=yes ; Status=E )
+    ; Status=no ),
+    $pyprism_end,
+    ( Status==yes -> write(' yes')
+    ; Status==no -> write(' no')
+    ; write(' Aborted by exception -- '),write(Status) ),
+    nl.
+$pyprism_rec([X|Xs]):-put_code(2),writeq(X),$pyprism_rec_(Xs).
+$pyprism_rec_([]):-put_code(3),nl.
+$pyprism_rec_([X|Xs]):-put_code(31),writeq(X),$pyprism_rec_(Xs).
+"""
+
+# prism_main for session mode: read goals from stdin one by one
+SESSION_MAIN=EXEC_DB+"""
+prism_main :-
+    $pyprism_ready,flush_output,
+    repeat,
+    catch(read(G),E,(G=$pyprism_syntax_error(E))),
+    ( G==end_of_file -> !
+    ; $pyprism_exec(G),flush_output,fail ).
+"""
+
+def frame_result(lines, status):
+    """Converts the output lines of one framed goal to (msgs, status)
+
+    A goal that raised an exception, including a syntax error in the goal,
+    gives (None, "error") like PrismEngine.query in batch mode; the exception
+    is left in the raw output (result_stdout).
+    """
+    if status not in ["yes","no"]:
+        return None, "error"
+    # the end marker is always preceded by a newline
+    if len(lines)>0 and lines[-1]=="":
+        lines=lines[:-1]
+    msgs=[el for el in lines if el[:10]!="** Warning" and el[:9]!="loading::"]
+    return msgs, status
+
+def parse_frames(out, n, missing="error"):
+    """Splits the stdout of a program that ran n framed goals into n (msgs, status)"""
+    results=[]
+    lines=None
+    for line in out:
+        if lines is None:
+            if line==READY_MARK:
+                lines=[]
+        elif line.startswith(END_MARK):
+            results.append(frame_result(lines, line[len(END_MARK)+1:]))
+            lines=[]
+        else:
+            lines.append(line)
+    # goals after a crash (or a timeout)
+    results+=[(None, missing)]*(n-len(results))
+    return results
+
+class PrismSession:
+    def __init__(self, bin_path, wd_path, code, args=[], keep_files=False, cmd=None, cpu_limit=None):
+        self.bin_path=bin_path
+        self.wd_path=wd_path
+        self.code=code
+        self.args=args
+        self.keep_files=keep_files
+        self.cmd=cmd if cmd is not None else [bin_path+"/upprism"]
+        # CPU time limit set by cmd (see PrismEngine.limit_resources)
+        self.cpu_limit=cpu_limit
+        self.proc=None
+        self.result_stdout=None
+        self.result_stderr=None
+        self._stderr=[]
+        self._stderr_lock=threading.Lock()
+        self._stderr_thread=None
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.close()
+        filename=write_program(self.code+"\n"+SESSION_MAIN, self.wd_path, prefix="session-")
+        cmds=self.cmd+[filename]+self.args
+        self.proc=subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True)
+        self._stderr=[]
+        self._stderr_thread=threading.Thread(target=self._read_stderr, args=(self.proc,), daemon=True)
+        self._stderr_thread.start()
+        ### wait for the program to be loaded
+        banner=[]
+        try:
+            self._wait_ready(banner)
+        finally:
+            # the loaded program is no longer needed on disk
+            if not self.keep_files:
+                remove_program(filename)
+
+    def _wait_ready(self, banner):
+        while True:
+            line=self.proc.stdout.readline()
+            if line==b"":
+                self.result_stdout=banner
+                self.result_stderr=self._take_stderr()
+                self.close()
+                raise RuntimeError("PRISM session failed to start:\n"+"\n".join(banner+self.result_stderr))
+            line=line.decode("utf8").rstrip("\n")
+            if line==READY_MARK:
+                break
+            banner.append(line)
+        self.result_stdout=banner
+        self.result_stderr=self._take_stderr()
+
+    def _read_stderr(self, proc):
+        for line in proc.stderr:
+            with self._stderr_lock:
+                self._stderr.append(line.decode("utf8").rstrip("\n"))
+
+    def _take_stderr(self):
+        with self._stderr_lock:
+            lines=self._stderr
+            self._stderr=[]
+        return lines
+
+    def query(self, q, timeout=None):
+        """Run goal q in the session and return (msgs, status) like PrismEngine.query
+
+        When timeout expires or PRISM is killed by cpu_limit, (None, "timeout")
+        is returned; the session restarts on the next query.
+        """
+        if not self.alive():
+            self.start()
+        try:
+            self.proc.stdin.write((q+".\n").encode("utf8"))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return self._crashed([])
+        timer=None
+        expired=threading.Event()
+        if timeout is not None:
+            timer=threading.Timer(timeout, self._expire, args=(self.proc, expired))
+            timer.start()
+        lines=[]
+        try:
+            status=self._read_frame(lines)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if expired.is_set() or status is None:
+            return self._crashed(lines, "timeout" if expired.is_set() else "error")
+        self.result_stdout=lines+["",status,""]
+        self.result_stderr=self._take_stderr()
+        return frame_result(lines, status)
+
+    def _expire(self, proc, expired):
+        expired.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _read_frame(self, lines):
+        # reads the output of one goal into lines and returns its status, or None at EOF
+        while True:
+            line=self.proc.stdout.readline()
+            if line==b"":
+                return None
+            line=line.decode("utf8").rstrip("\n")
+            if line.startswith(END_MARK):
+                return line[len(END_MARK)+1:]
+            lines.append(line)
+
+    def _crashed(self, lines, status="error"):
+        if self.proc is not None:
+            self.proc.wait()
+            # a process killed by RLIMIT_CPU also ran out of time
+            if self.proc.returncode in [-signal.SIGXCPU, -signal.SIGKILL] and self.cpu_limit is not None:
+                status="timeout"
+            if self._stderr_thread is not None:
+                self._stderr_thread.join()
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+        self.result_stdout=lines
+        self.result_stderr=self._take_stderr()
+        self.proc=None
+        return None, status
+
+    def close(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=5)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+        if self._stderr_thread is not None:
+            self._stderr_thread.join()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.proc=None
+
+    def __enter__(self):
+        if not self.alive():
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
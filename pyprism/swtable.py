@@ -0,0 +1,424 @@
+import os
+import gc
+import glob
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from pyprism.parser import iter_sw, serialize_term
+
+# version of the files written by SwitchTable.save
+TABLE_FORMAT = 1
+
+
+def _value(v):
+    # values of switches as hashable scalars
+    return v if isinstance(v, (str, int, float)) else serialize_term(v)
+
+
+def _save_strings(filename, strings):
+    # strings as one NUL-separated UTF-8 array
+    text = "\0".join(strings)
+    if text.count("\0") != max(len(strings) - 1, 0):
+        raise ValueError("strings containing NUL cannot be saved")
+    np.save(filename, np.frombuffer(text.encode("utf8"), dtype=np.uint8))
+
+
+def _load_strings(filename, n):
+    if n == 0:
+        return []
+    return bytes(np.load(filename, mmap_mode="r")).decode("utf8").split("\0")
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # building millions of small lists triggers the cyclic GC over and over
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _ranks(categories):
+    # rank of each category in the order sorted() gives (str() if they do not compare)
+    cats = list(categories)
+    try:
+        order = sorted(range(len(cats)), key=lambda i: cats[i])
+    except TypeError:
+        order = sorted(range(len(cats)), key=lambda i: str(cats[i]))
+    ranks = np.empty(len(cats), dtype=np.int64)
+    ranks[order] = np.arange(len(cats))
+    return ranks
+
+
+class SwitchTable:
+    """Switches in columns with their values and parameters in CSR layout
+
+    frame has one row per switch (Name, Arity, Term, Status, Arg1..ArgN as
+    categorical columns). The values and parameters of switch i are
+    values[offsets[i]:offsets[i+1]] and params[offsets[i]:offsets[i+1]];
+    values is a flat Categorical and params a flat float64 array.
+    Compound values are categories by their serialize_term text; terms maps
+    that text to the parsed term, which sw_data returns.
+    """
+
+    def __init__(self, frame, values, params, offsets, terms=None):
+        # frame may be a function building it on first use (see load)
+        self._frame = frame
+        self.values = values
+        self.params = params
+        self.offsets = offsets
+        self.terms = terms if terms is not None else {}
+        self._row_ids = None
+
+    @property
+    def frame(self):
+        if callable(self._frame):
+            self._frame = self._frame()
+        return self._frame
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds a table from switch records (read_sw, iter_sw or PrismEngine.learn)"""
+        names, arities, terms, statuses, args = [], [], [], [], []
+        values, params, sizes = [], [], []
+        compound, atoms = {}, set()
+        for r in records:
+            obj = r["term_obj"]
+            if isinstance(obj, dict) and "name" in obj:
+                names.append(str(obj["name"]))
+                arities.append(len(obj["args"]))
+                args.append([serialize_term(a) for a in obj["args"]])
+            else:
+                names.append(str(obj))
+                arities.append(0)
+                args.append([])
+            terms.append(r["term"])
+            statuses.append(r["status"])
+            if len(r["values"]) != len(r["params"]):
+                raise ValueError("switch {} has {} values and {} parameters".format(
+                    r["term"], len(r["values"]), len(r["params"])))
+            for v in r["values"]:
+                key = _value(v)
+                if key is not v:
+                    compound[key] = v
+                elif isinstance(v, str):
+                    atoms.add(v)
+                values.append(key)
+            params.extend(r["params"])
+            sizes.append(len(r["params"]))
+        m = max([len(a) for a in args] + [5])
+        frame = pd.DataFrame(
+            {
+                "Name": pd.Categorical(names),
+                "Arity": np.array(arities, dtype=np.int64),
+                "Term": pd.Categorical(terms),
+                "Status": pd.Categorical(statuses),
+            }
+        )
+        for i in range(m):
+            frame["Arg" + str(i + 1)] = pd.Categorical([a[i] if i < len(a) else "" for a in args])
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        clash = [key for key in compound if key in atoms]
+        if clash:
+            raise ValueError("switch value {} is both an atom and a term".format(clash[0]))
+        return cls(frame, pd.Categorical(values), np.array(params, dtype=np.float64), offsets, compound)
+
+    @classmethod
+    def from_file(cls, filename, processes=None):
+        """Reads a .sw file (see iter_sw)"""
+        return cls.from_records(iter_sw(filename, processes))
+
+    def save(self, dirname):
+        """Writes the table to the directory dirname as .npy arrays and meta.json"""
+        os.makedirs(dirname, exist_ok=True)
+        meta = {
+            "format": TABLE_FORMAT,
+            "n": len(self),
+            "columns": [],
+            "values": self.values.categories.tolist(),
+            "terms": [[k, v] for k, v in self.terms.items()],
+        }
+        for c in self.frame.columns:
+            col = self.frame[c]
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                cats = [str(x) for x in col.cat.categories]
+                _save_strings(os.path.join(dirname, c + ".categories.npy"), cats)
+                np.save(os.path.join(dirname, c + ".npy"), col.cat.codes.to_numpy())
+                meta["columns"].append([c, len(cats)])
+            else:
+                np.save(os.path.join(dirname, c + ".npy"), col.to_numpy())
+                meta["columns"].append([c, None])
+        np.save(os.path.join(dirname, "values.npy"), self.values.codes)
+        np.save(os.path.join(dirname, "params.npy"), self.params)
+        np.save(os.path.join(dirname, "offsets.npy"), self.offsets)
+        with open(os.path.join(dirname, "meta.json"), "w") as fp:
+            json.dump(meta, fp)
+
+    @classmethod
+    def load(cls, dirname, mmap=True):
+        """Reads a table written by save; with mmap=True the arrays are
+        read-only memory maps of the files. The frame of switches is read
+        when it is first used."""
+        with open(os.path.join(dirname, "meta.json")) as fp:
+            meta = json.load(fp)
+        if meta.get("format") != TABLE_FORMAT:
+            raise ValueError("unsupported switch table format: {}".format(meta.get("format")))
+        mode = "r" if mmap else None
+
+        def frame():
+            cols = {}
+            for c, n_cats in meta["columns"]:
+                data = np.load(os.path.join(dirname, c + ".npy"), mmap_mode=mode)
+                if n_cats is None:
+                    cols[c] = data
+                else:
+                    cats = _load_strings(os.path.join(dirname, c + ".categories.npy"), n_cats)
+                    dtype = pd.CategoricalDtype(pd.Index(cats, dtype=object))
+                    cols[c] = pd.Categorical.from_codes(data, dtype=dtype, validate=False)
+            return pd.DataFrame(cols)
+
+        values = pd.Categorical.from_codes(
+            np.load(os.path.join(dirname, "values.npy"), mmap_mode=mode),
+            dtype=pd.CategoricalDtype(pd.Index(meta["values"], dtype=object)),
+            validate=False,
+        )
+        params = np.load(os.path.join(dirname, "params.npy"), mmap_mode=mode)
+        offsets = np.load(os.path.join(dirname, "offsets.npy"), mmap_mode=mode)
+        return cls(frame, values, params, offsets, dict(meta.get("terms", [])))
+
+    def sw_data(self, use_array=False):
+        """The switches as parser.sw_data returns them: (rows, number of Arg columns)"""
+        n_arg = sum(1 for c in self.frame.columns if c.startswith("Arg"))
+        cols = [self.frame[c].tolist() for c in ["Name", "Arity", "Term", "Status"]]
+        args = [self.frame["Arg" + str(i + 1)].tolist() for i in range(n_arg)]
+        values = self.values.tolist()
+        if self.terms:
+            values = [self.terms.get(v, v) if isinstance(v, str) else v for v in values]
+        params = self.params.tolist()
+        offsets = self.offsets.tolist()
+        data = []
+        with _gc_paused():
+            for i, (name, arity, term, status) in enumerate(zip(*cols)):
+                vals = values[offsets[i] : offsets[i + 1]]
+                ps = params[offsets[i] : offsets[i + 1]]
+                if use_array:
+                    line = [name, arity, term, status, vals, ps]
+                else:
+                    line = [
+                        name,
+                        arity,
+                        term,
+                        status,
+                        "[" + ",".join(map(str, vals)) + "]",
+                        "[" + ",".join(map(str, ps)) + "]",
+                    ]
+                data.append((line, [a[i] for a in args[:arity]]))
+        return data, n_arg
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def sizes(self):
+        """Number of values of each switch"""
+        return np.diff(self.offsets)
+
+    @property
+    def row_ids(self):
+        """Switch of each entry of values/params"""
+        if self._row_ids is None:
+            self._row_ids = np.repeat(np.arange(len(self), dtype=np.int64), self.sizes)
+        return self._row_ids
+
+    def param_sums(self):
+        return np.bincount(self.row_ids, weights=self.params, minlength=len(self))
+
+    def is_normalized(self, atol=1e-6):
+        """Whether the parameters of each switch sum to one"""
+        return np.abs(self.param_sums() - 1.0) <= atol
+
+    def normalized(self):
+        """A table with the parameters of each switch divided by their sum"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            params = self.params / self.param_sums()[self.row_ids]
+        return SwitchTable(self._frame, self.values, params, self.offsets, self.terms)
+
+    def take(self, rows):
+        """A table with the switches rows (indices or a boolean mask), in that order"""
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        sizes = self.sizes[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        idx = np.repeat(self.offsets[rows] - offsets[:-1], sizes) + np.arange(offsets[-1])
+        frame = self.frame.iloc[rows].reset_index(drop=True)
+        return SwitchTable(frame, self.values[idx], self.params[idx], offsets, self.terms)
+
+    def _segment_order(self, *keys):
+        # entries sorted by switch and then by keys (the last key first, as np.lexsort)
+        sizes = self.sizes
+        if len(sizes) > 0 and sizes[0] > 0 and (sizes == sizes[0]).all():
+            # same number of values in every switch: sort the rows of a matrix
+            k = sizes[0]
+            order = np.lexsort(tuple(x.reshape(-1, k) for x in keys), axis=1)
+            return (order + self.offsets[:-1, None]).ravel()
+        return np.lexsort(keys + (self.row_ids,))
+
+    def top_k(self, k=1):
+        """The k most probable values of each switch as a DataFrame
+        (switch, Term, Rank, Value, Param), sorted by switch and rank"""
+        order = self._segment_order(-self.params)
+        rows = self.row_ids[order]
+        rank = np.arange(len(order)) - self.offsets[rows]
+        keep = rank < k
+        order, rows, rank = order[keep], rows[keep], rank[keep]
+        return pd.DataFrame(
+            {
+                "switch": rows,
+                "Term": self.frame["Term"].values[rows],
+                "Rank": rank,
+                "Value": self.values[order],
+                "Param": self.params[order],
+            }
+        )
+
+    def aligned(self, other):
+        """other with its switches in the order of this table; the switches
+        have to match by Term and have the same values"""
+        rows = pd.Index(other.frame["Term"].astype(str)).get_indexer(self.frame["Term"].astype(str))
+        if (rows < 0).any():
+            missing = self.frame["Term"].values[rows < 0]
+            raise ValueError("switches not found: {}".format(list(missing[:5])))
+        other = other.take(rows)
+        if not np.array_equal(self.offsets, other.offsets) or not np.array_equal(
+            np.asarray(self.values, dtype=object), np.asarray(other.values, dtype=object)
+        ):
+            raise ValueError("switches have different values")
+        return other
+
+    def kl_divergence(self, other):
+        """KL(self || other) of each switch; other is aligned by Term (see aligned)"""
+        q = self.aligned(other).params
+        p = self.params
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = np.where(p > 0, p * (np.log(p) - np.log(q)), 0.0)
+        return np.bincount(self.row_ids, weights=terms, minlength=len(self))
+
+    def dense(self):
+        """Parameters as a (switches, values) matrix with the values of each
+        switch sorted (like df.get_conditional_dist); returns (prob, value names)"""
+        sizes = self.sizes
+        if len(sizes) == 0:
+            return np.zeros((0, 0)), []
+        if (sizes != sizes[0]).any():
+            raise ValueError("switches have different numbers of values")
+        value_rank = _ranks(self.values.categories)[self.values.codes]
+        order = self._segment_order(self.params, value_rank)
+        prob = self.params[order].reshape(len(self), sizes[0])
+        names = [str(v) for v in self.values[order[: sizes[0]]]]
+        return prob, names
+
+    def to_frame(self):
+        """One row per value of each switch: switch, Term, Value, Param"""
+        rows = self.row_ids
+        return pd.DataFrame(
+            {
+                "switch": rows,
+                "Term": self.frame["Term"].values[rows],
+                "Value": self.values,
+                "Param": self.params,
+            }
+        )
+
+
+class SwitchTableCache:
+    """On-disk cache of the SwitchTables of .sw files
+
+    The table of a file is saved under cache_dir (by default .pyprism_cache
+    next to the file) in a directory named by the hash of its absolute path,
+    together with the size and mtime of the file; it is rebuilt when they
+    change. Tables are loaded as memory maps. After an entry is written, the
+    least recently used entries are removed beyond max_bytes in total or
+    when unused for max_age seconds.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=1 << 30, max_age=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def directory(self, filename=None):
+        if self.cache_dir is not None:
+            return self.cache_dir
+        if filename is None:
+            raise ValueError("filename is required when cache_dir is not set")
+        return os.path.join(os.path.dirname(os.path.abspath(filename)), ".pyprism_cache")
+
+    def entry(self, filename):
+        """The cache directory of the table of filename"""
+        key = hashlib.sha256(os.path.abspath(filename).encode("utf8")).hexdigest()[:32]
+        return os.path.join(self.directory(filename), "sw-" + key)
+
+    def load(self, filename, processes=None):
+        """The SwitchTable of the .sw file filename, from the cache if it is up to date"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        entry = self.entry(path)
+        source = {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        try:
+            with open(os.path.join(entry, "source.json")) as fp:
+                if json.load(fp) == source:
+                    table = SwitchTable.load(entry)
+                    os.utime(os.path.join(entry, "source.json"))
+                    return table
+        except (OSError, ValueError, KeyError):
+            pass
+        table = SwitchTable.from_file(path, processes)
+        tmp = "{}.tmp-{}".format(entry, os.getpid())
+        try:
+            table.save(tmp)
+            with open(os.path.join(tmp, "source.json"), "w") as fp:
+                json.dump(source, fp)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except (OSError, ValueError):
+            # not cached (read-only directory, strings that cannot be saved, ...)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return table
+        self.evict(path)
+        return table
+
+    def evict(self, filename=None):
+        """Removes old entries from the cache directory (of filename if cache_dir is None)"""
+        cache_dir = self.directory(filename)
+        entries = []
+        now = time.time()
+        for entry in glob.glob(os.path.join(cache_dir, "sw-*")):
+            try:
+                mtime = os.stat(os.path.join(entry, "source.json")).st_mtime
+                size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(entry, "*")))
+            except OSError:
+                continue
+            entries.append((mtime, size, entry))
+        entries.sort(reverse=True)
+        total = 0
+        for mtime, size, entry in entries:
+            total += size
+            if now - mtime > self.max_age or total > self.max_bytes:
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def clear(self, filename=None):
+        cache_dir = self.directory(filename)
+        for entry in glob.glob(os.path.join(cache_dir, "sw-*")):
+            shutil.rmtree(entry, ignore_errors=True)
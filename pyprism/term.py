@@ -0,0 +1,163 @@
+import sys
+from array import array
+from collections import namedtuple
+
+from pyprism.parser import parse_term, serialize_term, iter_sw_terms
+
+# Compact terms: the nodes of parse_term as immutable named tuples (no
+# per-node dict), with interned atoms and functor names.
+#   {'name':f, 'args':[...]}       -> Compound(f, (...))
+#   {'unary':op, 'expr':e}         -> Unary(op, e)
+#   {'binop':op, 'left':l, ...}    -> Binop(op, l, r)
+#   {'nullary':op}                 -> Nullary(op)
+#   {'tuple':[...]}                -> TermTuple((...))
+#   [...]                          -> tuple, or array('d') if all items are floats
+# atoms and numbers are kept as they are.
+Compound = namedtuple("Compound", ["name", "args"])
+Unary = namedtuple("Unary", ["op", "expr"])
+Binop = namedtuple("Binop", ["op", "left", "right"])
+Nullary = namedtuple("Nullary", ["op"])
+TermTuple = namedtuple("TermTuple", ["items"])
+
+class Interner:
+    """Shares equal atoms and lists between the terms converted with it"""
+    def __init__(self):
+        self.items={}
+
+    def atom(self, s):
+        return sys.intern(s)
+
+    def list(self, items):
+        if len(items)>0 and all(type(x) is float for x in items):
+            return array('d', items)
+        t=tuple(items)
+        # only lists of atoms and numbers (hashing nested tuples is not cached);
+        # keyed by type and text so that 1 and 1.0 (or 0.0 and -0.0) stay apart
+        if all(type(x) in (str, int, float) for x in t):
+            key=tuple((type(x), repr(x)) if type(x) is float else (type(x), x) for x in t)
+            return self.items.setdefault(key, t)
+        return t
+
+def _dict_children(obj):
+    # the subterms of a term in the dict format, or None for a leaf
+    if isinstance(obj, dict):
+        if 'name' in obj:
+            return obj['args']
+        if 'nullary' in obj:
+            return None
+        if 'unary' in obj:
+            return [obj['expr']]
+        if 'binop' in obj:
+            return [obj['left'], obj['right']]
+        if 'tuple' in obj:
+            return obj['tuple']
+    elif isinstance(obj, list):
+        return obj
+    return None
+
+def _compact_children(obj):
+    t=type(obj)
+    if t is Compound:
+        return obj.args
+    if t is Unary:
+        return [obj.expr]
+    if t is Binop:
+        return [obj.left, obj.right]
+    if t is TermTuple:
+        return obj.items
+    if t is tuple or t is array:
+        return obj
+    return None
+
+def _convert(obj, children, leaf, node):
+    # post-order walk with an explicit stack: node(obj, converted children)
+    out=[]
+    stack=[(obj, None)]
+    while stack:
+        obj, cs=stack.pop()
+        if cs is not None:
+            n=len(cs)
+            args=out[len(out)-n:]
+            del out[len(out)-n:]
+            out.append(node(obj, args))
+            continue
+        cs=children(obj)
+        if cs is None:
+            out.append(leaf(obj))
+            continue
+        stack.append((obj, cs))
+        for c in reversed(cs):
+            stack.append((c, None))
+    return out[0]
+
+def from_dict(obj, interner=None):
+    """Converts a term parsed by parse_term to the compact representation"""
+    interner=interner if interner is not None else Interner()
+    def leaf(o):
+        if isinstance(o, str):
+            return interner.atom(o)
+        if isinstance(o, dict) and 'nullary' in o:
+            return Nullary(interner.atom(o['nullary']))
+        if isinstance(o, (int, float)):
+            return o
+        raise TypeError(f"Unsupported type: {type(o)}")
+    def node(o, args):
+        if isinstance(o, list):
+            return interner.list(args)
+        if 'name' in o:
+            return Compound(interner.atom(o['name']), tuple(args))
+        if 'unary' in o:
+            return Unary(interner.atom(o['unary']), args[0])
+        if 'binop' in o:
+            return Binop(interner.atom(o['binop']), args[0], args[1])
+        return TermTuple(tuple(args))
+    return _convert(obj, _dict_children, leaf, node)
+
+def to_dict(obj):
+    """Converts a compact term back to the format of parse_term"""
+    def leaf(o):
+        if type(o) is Nullary:
+            return {'nullary': o.op}
+        return o
+    def node(o, args):
+        t=type(o)
+        if t is Compound:
+            return {'name': o.name, 'args': args}
+        if t is Unary:
+            return {'unary': o.op, 'expr': args[0]}
+        if t is Binop:
+            return {'binop': o.op, 'left': args[0], 'right': args[1]}
+        if t is TermTuple:
+            return {'tuple': args}
+        return args
+    return _convert(obj, _compact_children, leaf, node)
+
+def parse_compact(s, interner=None):
+    return from_dict(parse_term(s), interner)
+
+def serialize_compact(obj, unary_op_paren=True, binary_op_paren=True):
+    return serialize_term(to_dict(obj), unary_op_paren, binary_op_paren)
+
+class SwitchRecord(namedtuple("SwitchRecord", ["term", "status", "values", "params"])):
+    """A switch of a .sw file with its term, values and parameters in the compact representation"""
+    __slots__=()
+
+    def to_record(self):
+        """The record of read_sw for this switch"""
+        obj=to_dict(self.term)
+        return {"term":serialize_term(obj),
+                "term_obj":obj,
+                "status":self.status,
+                "values":to_dict(self.values),
+                "params":to_dict(self.params)}
+
+def compact_sw(sw, interner):
+    """A parsed switch(Sw,Status,Values,Params) term to a SwitchRecord"""
+    args=sw["args"]
+    return SwitchRecord(from_dict(args[0], interner), interner.atom(args[1]),
+            from_dict(args[2], interner), from_dict(args[3], interner))
+
+def read_sw_compact(filename, interner=None, processes=None):
+    """Like read_sw, but the switches are SwitchRecords sharing their atoms and value lists"""
+    interner=interner if interner is not None else Interner()
+    return [compact_sw(sw, interner) for sw in iter_sw_terms(filename, processes)]
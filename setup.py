@@ -12,6 +12,7 @@ setup(
     entry_points={
         'console_scripts':[
             'pyprism = pyprism.main:main',
+            'pyprism-bench = pyprism.bench:main',
         ],
     },
     include_package_data=True,
@@ -0,0 +1,16 @@
+from pyprism import PrismEngine
+import pyprism
+
+engine=PrismEngine(bin_path="../prism/bin")
+db="""
+mem(N, A,B) :- member(A,[1,2,3,4,5,6,7,8,9]),member(B,[1,2,3,4,5,6,7,8,9]), N is A+B.
+"""
+
+engine.set_db(db)
+engine.start_session()
+
+query='mem(8, A, Z),mem(8, X, Y)'
+print(engine.query(query, find_n=10, out=["A","Z","X","Y"]))
+print(engine.query('mem(N, 3, 4)', out=["N"]))
+print(engine.query('mem(100, A, B)', out=["A","B"]))
+engine.stop_session()
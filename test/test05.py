@@ -0,0 +1,14 @@
+from pyprism import PrismEngine
+import pyprism
+
+engine=PrismEngine(bin_path="../prism/bin")
+db="""
+values(coin(_),[h,t]).
+toss(N,X) :- msw(coin(N),X).
+"""
+
+engine.set_db(db)
+switches, stats=engine.learn(["toss(1,h)","toss(1,h)","toss(1,t)","toss(2,t)"])
+for sw in switches:
+    print(sw["term"], sw["values"], sw["params"])
+print(stats["log_likelihood"], stats["num_iterations"])
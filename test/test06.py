@@ -0,0 +1,19 @@
+from pyprism import PrismEngine
+import pyprism
+
+engine=PrismEngine(bin_path="../prism/bin")
+db="""
+:- dynamic edge/2.
+edge(a,b).
+path(X,Y) :- edge(X,Y).
+path(X,Y) :- edge(X,Z),path(Z,Y).
+"""
+
+engine.set_db(db)
+engine.start_session()
+
+engine.add_facts("edge", [("b","c"), ("c","d")])
+print(engine.query('path(a, X)', findall=True, out=["X"]))
+print(engine.retract('edge(b, _)'))
+print(engine.query('path(a, X)', findall=True, out=["X"]))
+engine.stop_session()
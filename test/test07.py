@@ -0,0 +1,25 @@
+import os
+import shutil
+import tempfile
+import pandas as pd
+from pyprism.parser import read_sw_data
+from pyprism.df import sw2df
+from pyprism.swtable import SwitchTableCache
+
+d=tempfile.mkdtemp()
+filename=os.path.join(d, "compound.sw")
+with open(filename, "w") as fp:
+    fp.write("switch(s(1),unfixed,[g(1),g(2),a],[0.2,0.3,0.5]).\n")
+    fp.write("switch(s(2),unfixed,[f(x,[1,2]),'b c',3],[0.1,0.6,0.3]).\n")
+
+cache=SwitchTableCache(cache_dir=os.path.join(d, "cache"))
+for use_array in [False, True]:
+    ref=read_sw_data(filename, use_array=use_array)
+    # the first call builds the cache, the second one reads it
+    for i in range(2):
+        data=read_sw_data(filename, use_array=use_array, cache=cache)
+        assert data==ref, (data, ref)
+print(read_sw_data(filename, use_array=True, cache=cache)[0][0][0][4])
+pd.testing.assert_frame_equal(sw2df(filename), sw2df(filename, cache=cache))
+shutil.rmtree(d)
+print("ok")
@@ -0,0 +1,28 @@
+import random
+import sys
+import pyprism
+
+# parse_term against the recursive parser on TokenStream for random token strings
+sys.setrecursionlimit(10000)
+pieces=['a','f','g(','Xy','_v','"s t"',"'q\\'x'","'-'",'1','2.5','3e2','.5','1.','+','-','*','/','=','=<',':-','>=','==','=\\=',';','|','!',',','(',')','[',']',' ','  \n','\t','x1','?-','\\']
+
+def run(f, s):
+    try:
+        return ("ok", f(s))
+    except RecursionError:
+        return ("recursion",)
+    except Exception as e:
+        return (type(e).__name__, str(e))
+
+def parse_recursive(s):
+    return pyprism.parse_expr(pyprism.TokenStream(pyprism.tokenize(s)))
+
+rng=random.Random(int(sys.argv[1]) if len(sys.argv)>1 else 0)
+ok=0
+for i in range(50000):
+    s="".join(rng.choice(pieces) for _ in range(rng.randint(0,25)))
+    a=run(pyprism.parse_term, s)
+    b=run(parse_recursive, s)
+    assert a==b, (s, a, b)
+    ok+=a[0]=="ok"
+print("same results,", ok, "terms parsed")
@@ -0,0 +1,71 @@
+import random
+import re
+import sys
+import pyprism
+
+# serialize_term against a recursive serializer on random terms and deep nesting
+sys.setrecursionlimit(10000)
+pieces=['a','f','g(','Xy','_v','"s t"',"'q\\'x'","'-'",'1','2.5','3e2','.5','1.','+','-','*','/','=','=<',':-','>=','==','=\\=',';','|','!',',','(',')','[',']',' ','  \n','\t','x1','?-','\\']
+name_pattern=re.compile(r'^[A-Za-z_][A-Za-z_0-9]*$')
+
+def serialize_recursive(obj, unary_op_paren=True, binary_op_paren=True):
+    if isinstance(obj, dict) and 'name' in obj:
+        args = ','.join(serialize_recursive(arg) for arg in obj['args'])
+        return f"{obj['name']}({args})"
+    if isinstance(obj, dict) and 'nullary' in obj:
+        return f"{obj['nullary']}"
+    if isinstance(obj, dict) and 'unary' in obj:
+        expr = serialize_recursive(obj["expr"])
+        return f"({obj['unary']}{expr})" if unary_op_paren else f"{obj['unary']}{expr}"
+    if isinstance(obj, dict) and 'binop' in obj:
+        lhs = serialize_recursive(obj["left"])
+        rhs = serialize_recursive(obj["right"])
+        return f"({lhs}{obj['binop']}{rhs})" if binary_op_paren else f"{lhs}{obj['binop']}{rhs}"
+    if isinstance(obj, dict) and 'tuple' in obj:
+        return '(' + ','.join(serialize_recursive(item) for item in obj["tuple"]) + ')'
+    elif isinstance(obj, list):
+        return '[' + ','.join(serialize_recursive(item) for item in obj) + ']'
+    elif isinstance(obj, str):
+        if name_pattern.match(obj):
+            return obj
+        return '"' + obj.replace('"', '\\"') + '"'
+    elif isinstance(obj, (int, float)):
+        return str(obj)
+    else:
+        raise TypeError(f"Unsupported type: {type(obj)}")
+
+def run(f, *args):
+    try:
+        return ("ok", f(*args))
+    except Exception as e:
+        return (type(e).__name__, str(e))
+
+flags=[(True,True),(False,True),(True,False),(False,False)]
+rng=random.Random(int(sys.argv[1]) if len(sys.argv)>1 else 0)
+n=0
+for i in range(50000):
+    s="".join(rng.choice(pieces) for _ in range(rng.randint(0,30)))
+    try:
+        obj=pyprism.parse_term(s)
+    except SyntaxError:
+        continue
+    for fl in flags:
+        a=run(pyprism.serialize_term, obj, *fl)
+        b=run(serialize_recursive, obj, *fl)
+        assert a==b, (s, fl, a, b)
+    n+=1
+for obj in [{'name':'f','args':[(1,)]}, {'binop':'+','left':[],'right':{'tuple':[]}}, {'name':'f','args':['a b','x"y']}, {'foo':1}, None]:
+    for fl in flags:
+        a=run(pyprism.serialize_term, obj, *fl)
+        b=run(serialize_recursive, obj, *fl)
+        assert a==b, (obj, fl, a, b)
+print("same results for", n, "terms")
+
+# deep terms (the recursive versions fail at a depth of a few thousands)
+depth=100000
+for s in ["["*depth+"a"+"]"*depth, "f("*depth+"1"+")"*depth, "- "*depth+"1", "1+"*depth+"1"]:
+    obj=pyprism.parse_term(s)
+    out=pyprism.serialize_term(obj)
+    # == on the nested dicts would recurse
+    assert pyprism.serialize_term(pyprism.parse_term(out))==out, s[:20]
+print("depth", depth, "ok")
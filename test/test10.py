@@ -0,0 +1,82 @@
+import io
+import os
+import gzip
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pyprism.dataset import to_dat
+
+# to_dat against the row-by-row writer it replaced, on columns of every dtype
+
+def to_dat_rows(X_discretized, y_discretized, pred="data", with_y=True):
+    aligned_y = y_discretized.reindex(X_discretized.index)
+    lines = []
+    for index, row in X_discretized.iterrows():
+        row_list = [str(int(x)) if pd.notna(x) else "_" for x in row.tolist()]
+        y_value = aligned_y.loc[index] if index in aligned_y.index and pd.notna(aligned_y.loc[index]) else "_"
+        if y_value != "_":
+            y_value = str(int(y_value))
+        if with_y:
+            lines.append(pred + "(" + y_value + ",[" + ",".join(row_list) + "]).\n")
+        else:
+            lines.append(pred + "([" + ",".join(row_list) + "]).\n")
+    return "".join(lines)
+
+rng=np.random.default_rng(0)
+n=50
+base=pd.DataFrame({"a":rng.integers(0,5,n).astype(float),"b":rng.normal(size=n)*3,"c":rng.integers(-3,3,n)})
+base.loc[rng.random(n)<0.2,"a"]=np.nan
+base.loc[rng.random(n)<0.2,"b"]=np.nan
+y=pd.Series(rng.integers(0,8,n).astype(float))
+y[rng.random(n)<0.2]=np.nan
+cases={
+    "mixed":(base,y),
+    "ints":(base[["c"]],y),
+    "int and float":(pd.DataFrame({"i":[2**60+1,3],"f":[0.5,1.5]}),pd.Series([1,2])),
+    "bool":(pd.DataFrame({"b":[True,False,True]}),pd.Series([1.0,2.0,3.0])),
+    "bool and float":(pd.DataFrame({"b":[True,False],"f":[1.2,np.nan]}),pd.Series([1,2])),
+    "nullable":(pd.DataFrame({"n":pd.array([1,None,3],dtype="Int64"),"f":[1.0,2.0,np.nan]}),pd.Series(pd.array([None,2,3],dtype="Int64"))),
+    "object":(pd.DataFrame({"o":["1","2",None]}),pd.Series([1.0,np.nan,3.0])),
+    "all missing":(pd.DataFrame({"x":[np.nan,np.nan]}),pd.Series([np.nan,np.nan])),
+    "huge float":(pd.DataFrame({"x":[1e20,-3.7]}),pd.Series([1.0,2.0])),
+    "negative":(pd.DataFrame({"x":[-0.5,-1.5,-0.0]}),pd.Series([-1.9,0.2,3.0])),
+    "uint64":(pd.DataFrame({"u":np.array([0,2**63,2**64-1],dtype=np.uint64)}),pd.Series([1,2,3])),
+    "y missing index":(pd.DataFrame({"x":[1.0,2.0,3.0]},index=[10,11,12]),pd.Series([5.0,6.0],index=[11,99])),
+    "string index":(pd.DataFrame({"x":[1,2]},index=["p","q"]),pd.Series([3,4],index=["q","p"])),
+    "no columns":(pd.DataFrame(index=range(3)),pd.Series([1,2,3])),
+    "empty":(base.iloc[:0],y.iloc[:0]),
+    "wide range":(pd.DataFrame({"x":[0,10**9,-10**12]}),pd.Series([1,2,3])),
+}
+d=tempfile.mkdtemp()
+filename=os.path.join(d, "out.dat")
+for name,(X,yy) in cases.items():
+    for with_y in [True, False]:
+        to_dat(X, yy, filename, pred="p", with_y=with_y, chunk_size=7)
+        with open(filename) as fp:
+            assert fp.read()==to_dat_rows(X, yy, pred="p", with_y=with_y), name
+    print("ok", name)
+
+# the same errors as the row-by-row writer
+for X in [pd.DataFrame({"x":[np.inf]}), pd.DataFrame({"x":["a"]})]:
+    errors=[]
+    for f in [lambda: to_dat_rows(X, pd.Series([1])), lambda: to_dat(X, pd.Series([1]), filename)]:
+        try:
+            f()
+            errors.append(None)
+        except Exception as e:
+            errors.append(type(e))
+    assert errors[0]==errors[1] and errors[0] is not None, errors
+
+# gzip and file objects
+ref=to_dat_rows(base, y)
+to_dat(base, y, filename+".gz")
+assert gzip.open(filename+".gz","rt").read()==ref
+b=io.BytesIO()
+to_dat(base, y, b)
+assert b.getvalue().decode("utf8")==ref
+t=io.StringIO()
+to_dat(base, y, t)
+assert t.getvalue()==ref
+shutil.rmtree(d)
+print("ok")